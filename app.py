@@ -6,35 +6,80 @@
 # App — Pareto 80/20 + Portafolio + Unificado + Sheets + Informe PDF
 # Ejecuta: streamlit run app.py
 
+import functools
+import hashlib
 import io
+import os
+import random
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from textwrap import wrap
-from typing import List, Dict, Tuple
+from types import MappingProxyType
+from typing import TYPE_CHECKING, List, Dict, Tuple, Optional
+
+try:
+    import resource  # RSS pico (solo POSIX)
+except ImportError:  # pragma: no cover - Windows
+    resource = None
 from datetime import datetime
 
 import numpy as np
 import pandas as pd
 import streamlit as st
-import matplotlib.pyplot as plt
-
-# ====== Google Sheets (DB) ======
-import gspread
-from google.oauth2.service_account import Credentials
-
-# ====== PDF (ReportLab/Platypus) ======
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import cm
-from reportlab.platypus import (
-    BaseDocTemplate, PageTemplate, Frame,
-    Paragraph, Spacer, Image as RLImage, Table, TableStyle,
-    PageBreak, NextPageTemplate
-)
-from reportlab.platypus.flowables import KeepTogether
+
+# Matplotlib, Plotly, gspread/google-auth y ReportLab se importan dentro de la
+# primera función que los usa: el arranque en frío y el primer render no pagan
+# los módulos que solo hacen falta al dibujar, conectar con Sheets o generar un
+# PDF. Python los carga una vez por proceso; después es una búsqueda en sys.modules.
+if TYPE_CHECKING:  # solo para anotaciones
+    import plotly.graph_objects as go
+    from reportlab.platypus import Image as RLImage, Table
+
+_T0_RERUN = time.perf_counter()  # para medir el costo de cada rerun completo
 
 # ----------------- CONFIG (tu Sheets y pestaña) -----------------
 SPREADSHEET_URL = "https://docs.google.com/spreadsheets/d/1XZjXQfLb5Jiptp_BXuCfg9QZNEz6ZWh9hbtp0rRAGpM/edit?usp=sharing"
 WS_PARETOS = "paretos"  # cambia si tu pestaña se llama diferente
+PORTAFOLIO_TTL_SEG = 300  # vigencia del portafolio compartido entre sesiones
+# Almacén primario: "sheets" lee/escribe directo en Google Sheets; "sqlite" sirve desde
+# SQLITE_RUTA y replica a Sheets en segundo plano (push por la cola, pull cada SYNC_INTERVALO_SEG).
+ALMACEN_PRIMARIO = "sheets"
+SQLITE_RUTA = "portafolio.db"
+SYNC_INTERVALO_SEG = 120
+# Almacenamiento: "snapshot" reescribe en sitio la pestaña 'paretos';
+# "log" agrega eventos a WS_LOG (un append por escritura) y compacta al pasar LOG_MAX_FILAS.
+MODO_ALMACEN = "snapshot"
+WS_LOG = "paretos_log"
+LOG_MAX_FILAS = 5000
+# Turno de compactación entre réplicas: celda del encabezado del log (fuera de HEADER_LOG)
+# con "token|vence_epoch". Quien lo tiene compacta; vence solo si el proceso muere.
+LOG_TURNO_CELDA = "G1"
+LOG_TURNO_SEG = 120
+# Fragmentos del portafolio (p. ej. una hoja por región o por año). Se leen en paralelo y
+# cada nombre se escribe en el fragmento que lo contiene; los nombres nuevos van al primer
+# fragmento cuyo prefijo coincida, o al primero de la lista.
+FRAGMENTOS: List[Dict] = [
+    {"url": SPREADSHEET_URL, "ws": WS_PARETOS, "log": WS_LOG, "prefijos": []},
+    # {"url": "https://docs.google.com/spreadsheets/d/.../edit", "ws": "paretos",
+    #  "log": "paretos_log", "prefijos": ["Región Huetar Norte"]},
+]
+FRAGMENTOS_MAX_HILOS = 4
+LECTURA_BLOQUE_FILAS = 2000  # filas por rango A1 en las lecturas por bloques
+SHEETS_CUOTA_POR_MIN = 60       # presupuesto de solicitudes por minuto (cuota por usuario de la API)
+SHEETS_MAX_REINTENTOS = 5       # reintentos ante 429/5xx
+SHEETS_BACKOFF_BASE_SEG = 1.0
+SHEETS_BACKOFF_MAX_SEG = 32.0
+ESCRITURA_VENTANA_SEG = 2.0     # guardados dentro de esta ventana se agrupan en un solo batch
+ESCRITURA_REINTENTO_SEG = 10.0  # espera base antes de reintentar una escritura fallida
+ESTADO_SYNC_CADA_SEG = 5        # el indicador de sincronización se refresca solo con este período
+GRAFICOS_CACHE_MAX_BYTES = 96 * 1024 * 1024  # PNGs renderizados en memoria (LRU por bytes)
+GRAFICOS_CACHE_DIR: Optional[str] = None     # p. ej. ".cache_graficos" para respaldar en disco
 
 st.set_page_config(page_title="Pareto de Descriptores", layout="wide")
 
@@ -44,17 +89,15 @@ AZUL  = "#2C7FB8"
 TEXTO = "#124559"
 GRIS  = "#6B7280"
 
-# Matplotlib
-plt.rcParams.update({
-    "figure.dpi": 180,
-    "savefig.dpi": 180,
-    "axes.titlesize": 18,
-    "axes.labelsize": 13,
-    "xtick.labelsize": 10,
-    "ytick.labelsize": 11,
-    "axes.grid": True,
-    "grid.alpha": 0.25,
-})
+# Matplotlib: el estilo se aplica a cada figura (rcParams es global y no es thread-safe)
+ESTILO_GRAFICOS = {
+    "dpi": 180,
+    "titulo": 18,
+    "etiquetas": 13,
+    "xticks": 10,
+    "yticks": 11,
+    "grid_alpha": 0.25,
+}
 # ============================================================================
 # ============================== PARTE 2/10 =================================
 # ========================= Catálogo embebido (CSV) =========================
@@ -234,49 +277,194 @@ CATALOGO: List[Dict[str, str]] = [
 # ====================== Utilidades base y cálculo Pareto ====================
 # ============================================================================
 
-def _map_descriptor_a_categoria() -> Dict[str, str]:
-    df = pd.DataFrame(CATALOGO)
-    return dict(zip(df["descriptor"], df["categoria"]))
-DESC2CAT = _map_descriptor_a_categoria()
+# --- Etiquetado temático (el índice del catálogo lo precalcula por descriptor) ---
+def _tema_descriptor(descriptor: str) -> str:
+    d = descriptor.lower()
+    if "droga" in d or "búnker" in d or "bunker" in d or "narco" in d or "venta de drogas" in d:
+        return "drogas"
+    if "robo" in d or "hurto" in d or "asalto" in d or "vehícul" in d or "comercio" in d:
+        return "delitos contra la propiedad"
+    if "violencia" in d or "lesion" in d or "homicidio" in d:
+        return "violencia"
+    if "infraestructura" in d or "alumbrado" in d or "lotes" in d:
+        return "condiciones urbanas / entorno"
+    return "seguridad y convivencia"
+
 
+# --- Índice del catálogo (inmutable, uno por proceso) ---
+def _clave_descriptor(texto) -> str:
+    """Clave de búsqueda: sin tildes, sin distinguir mayúsculas y con espacios colapsados."""
+    t = unicodedata.normalize("NFKD", str(texto))
+    t = "".join(c for c in t if not unicodedata.combining(c))
+    return " ".join(t.casefold().split())
 
-def normalizar_freq_map(freq_map: Dict[str, int]) -> Dict[str, int]:
-    out = {}
-    for d, v in (freq_map or {}).items():
+
+class IndiceCatalogo:
+    """
+    CATALOGO indexado una sola vez: id entero por descriptor, búsqueda tolerante a
+    tildes/mayúsculas/espacios, categoría y tema por id y etiquetas ya envueltas para los
+    anchos que usan los gráficos. Todo es de solo lectura salvo la caché de etiquetas
+    fuera del catálogo.
+    """
+    ANCHOS_ETIQUETA = (14, 15, 16, 18, 20, 22, 25, 35)
+    MAX_ETIQUETAS_LIBRES = 4096
+
+    def __init__(self, catalogo: List[Dict[str, str]]):
+        cat = {r["descriptor"]: r["categoria"] for r in catalogo}
+        self.descriptores: Tuple[str, ...] = tuple(cat)
+        self.categorias: Tuple[str, ...] = tuple(cat.values())
+        self.temas: Tuple[str, ...] = tuple(_tema_descriptor(d) for d in self.descriptores)
+        self.id_de = MappingProxyType({d: i for i, d in enumerate(self.descriptores)})
+        self.desc2cat = MappingProxyType(cat)
+        self._por_clave = {_clave_descriptor(d): i for i, d in enumerate(self.descriptores)}
+        self._etiquetas = {w: tuple("\n".join(wrap(d, width=w)) for d in self.descriptores)
+                           for w in self.ANCHOS_ETIQUETA}
+        self._etiquetas_libres: Dict[Tuple[str, int], str] = {}
+
+    def buscar(self, texto) -> Optional[int]:
+        """Id del descriptor del catálogo (coincidencia exacta o normalizada) o None."""
+        i = self.id_de.get(texto)
+        if i is None:
+            i = self._por_clave.get(_clave_descriptor(texto))
+        return i
+
+    def canonico(self, texto) -> str:
+        """Descriptor tal como está en el catálogo; el texto libre se devuelve recortado."""
+        i = self.buscar(texto)
+        return self.descriptores[i] if i is not None else str(texto).strip()
+
+    def categoria(self, texto) -> str:
+        i = self.buscar(texto)
+        return self.categorias[i] if i is not None else "—"
+
+    def tema(self, texto) -> str:
+        i = self.buscar(texto)
+        return self.temas[i] if i is not None else _tema_descriptor(str(texto))
+
+    def categorias_de(self, valores: pd.Series) -> pd.Series:
+        """categoria() vectorizada: se resuelve una vez por valor distinto."""
+        return valores.map({v: self.categoria(v) for v in pd.unique(valores)})
+
+    def temas_de(self, valores: pd.Series) -> pd.Series:
+        """tema() vectorizada: se resuelve una vez por valor distinto."""
+        return valores.map({v: self.tema(v) for v in pd.unique(valores)})
+
+    def etiqueta(self, texto, width: int) -> str:
+        """Etiqueta envuelta a 'width' columnas (precalculada para el catálogo)."""
+        i = self.id_de.get(texto)
+        if i is not None and width in self._etiquetas:
+            return self._etiquetas[width][i]
+        clave = (str(texto), width)
+        env = self._etiquetas_libres.get(clave)
+        if env is None:
+            if len(self._etiquetas_libres) >= self.MAX_ETIQUETAS_LIBRES:
+                self._etiquetas_libres.clear()
+            env = self._etiquetas_libres[clave] = "\n".join(wrap(clave[0], width=width))
+        return env
+
+
+@st.cache_resource(show_spinner=False)
+def _indice_catalogo() -> IndiceCatalogo:
+    return IndiceCatalogo(CATALOGO)
+
+
+INDICE = _indice_catalogo()
+DESC2CAT = INDICE.desc2cat  # alias de compatibilidad (solo lectura)
+
+
+class MapaFrecuencias(Mapping):
+    """
+    Mapa descriptor -> frecuencia ya validado (enteros > 0) e inmutable.
+    Se construye una sola vez en la frontera (editor, carga de Sheets/SQLite) y el
+    resto del flujo lo acepta sin volver a normalizar. Respaldado por arreglos:
+    len y total son O(1).
+    """
+    ES_MAPA_FRECUENCIAS = True  # marca por atributo: la clase se redefine en cada rerun de Streamlit
+    __slots__ = ("_desc", "_freq", "_pos", "_total")
+
+    def __init__(self, descriptores: Tuple[str, ...], frecuencias: np.ndarray):
+        """Constructor de confianza: usar MapaFrecuencias.desde() para datos sin validar."""
+        self._desc = tuple(descriptores)
+        self._freq = np.asarray(frecuencias, dtype=np.int64)
+        self._freq.setflags(write=False)
+        self._pos: Optional[Dict[str, int]] = None
+        self._total = int(self._freq.sum())
+
+    @classmethod
+    def desde(cls, freq_map) -> "MapaFrecuencias":
+        """
+        Valida una sola vez: coerción numérica vectorizada, truncado a entero y solo > 0.
+        Descarta descriptores nulos o en blanco (p. ej. filas nuevas del editor sin descriptor).
+        """
+        if getattr(freq_map, "ES_MAPA_FRECUENCIAS", False):
+            return freq_map
+        items = [(d if isinstance(d, str) else str(d), v) for d, v in (freq_map or {}).items()
+                 if not pd.isna(d) and str(d).strip()]
+        if not items:
+            return cls((), np.zeros(0, dtype=np.int64))
+        descs = [d for d, _ in items]
+        vals = [v for _, v in items]
         try:
-            vv = int(pd.to_numeric(v, errors="coerce"))
-            if vv > 0:
-                out[d] = vv
-        except Exception:
-            continue
-    return out
+            if all(isinstance(v, (int, float, np.integer, np.floating)) for v in vals):
+                num = np.fromiter(vals, dtype=float, count=len(vals))  # caso común: ya son números
+            else:
+                num = pd.to_numeric(pd.Series(vals, dtype=object), errors="coerce").to_numpy(float)
+        except (TypeError, ValueError):
+            num = np.array([pd.to_numeric(v, errors="coerce") if np.ndim(v) == 0 else np.nan
+                            for _, v in items], dtype=float)
+        enteros = np.trunc(np.where(np.isfinite(num), num, 0)).astype(np.int64)
+        ok = np.flatnonzero(enteros > 0)
+        return cls(tuple(descs[i] for i in ok), enteros[ok])
 
+    @classmethod
+    def de_enteros(cls, freq_map: Dict[str, int]) -> "MapaFrecuencias":
+        """Para fuentes ya validadas (p. ej. el DataFrame agregado de Sheets): sin coerción."""
+        return cls(tuple(freq_map), np.fromiter(freq_map.values(), dtype=np.int64, count=len(freq_map)))
 
-def df_desde_freq_map(freq_map: Dict[str, int]) -> pd.DataFrame:
-    items = []
-    for d, f in normalizar_freq_map(freq_map).items():
-        items.append({
-            "descriptor": d,
-            "categoria": DESC2CAT.get(d, "—"),
-            "frecuencia": int(f)
-        })
-    df = pd.DataFrame(items)
-    if df.empty:
-        return pd.DataFrame(columns=["descriptor", "categoria", "frecuencia"])
-    return df
+    @property
+    def total(self) -> int:
+        return self._total
+
+    @property
+    def descriptores(self) -> Tuple[str, ...]:
+        return self._desc
+
+    @property
+    def frecuencias(self) -> np.ndarray:
+        return self._freq
+
+    def __len__(self) -> int:
+        return len(self._desc)
+
+    def __iter__(self):
+        return iter(self._desc)
 
+    def __getitem__(self, descriptor: str) -> int:
+        if self._pos is None:
+            self._pos = {d: i for i, d in enumerate(self._desc)}
+        return int(self._freq[self._pos[descriptor]])
 
-def combinar_maps(maps: List[Dict[str, int]]) -> Dict[str, int]:
-    total = {}
-    for m in maps:
-        for d, f in normalizar_freq_map(m).items():
-            total[d] = total.get(d, 0) + int(f)
-    return total
+    def items(self):
+        return zip(self._desc, self._freq.tolist())
 
+    def __repr__(self) -> str:
+        return f"MapaFrecuencias({dict(self.items())!r})"
 
-def info_pareto(freq_map: Dict[str, int]) -> Dict[str, int]:
-    d = normalizar_freq_map(freq_map)
-    return {"descriptores": len(d), "total": int(sum(d.values()))}
+
+def normalizar_freq_map(freq_map: Dict[str, int]) -> MapaFrecuencias:
+    """Sin costo si ya es un MapaFrecuencias; si no, lo valida una vez."""
+    return MapaFrecuencias.desde(freq_map)
+
+
+def df_desde_freq_map(freq_map: Dict[str, int]) -> pd.DataFrame:
+    m = normalizar_freq_map(freq_map)
+    if not len(m):
+        return pd.DataFrame(columns=["descriptor", "categoria", "frecuencia"])
+    return pd.DataFrame({
+        "descriptor": list(m.descriptores),
+        "categoria": [INDICE.categoria(d) for d in m.descriptores],
+        "frecuencia": m.frecuencias.astype(int),
+    })
 
 
 # --- Cálculo Pareto ---
@@ -287,7 +475,7 @@ def calcular_pareto(df_in: pd.DataFrame) -> pd.DataFrame:
     if df.empty:
         return df.assign(porcentaje=0.0, acumulado=0, pct_acum=0.0,
                          segmento_real="20%", segmento="80%")
-    df = df.sort_values("frecuencia", ascending=False)
+    df = df.sort_values("frecuencia", ascending=False, kind="stable")  # empates: orden de entrada
     total = int(df["frecuencia"].sum())
     df["porcentaje"] = (df["frecuencia"] / total * 100).round(2)
     df["acumulado"]  = df["frecuencia"].cumsum()
@@ -297,6 +485,224 @@ def calcular_pareto(df_in: pd.DataFrame) -> pd.DataFrame:
     return df.reset_index(drop=True)
 
 
+def calcular_paretos_lote(df_largo: pd.DataFrame) -> pd.DataFrame:
+    """
+    Todos los Paretos de una tabla larga (nombre, descriptor, frecuencia) en una sola pasada:
+    orden agrupado + cumsum por grupo. Por cada nombre da el mismo resultado que calcular_pareto.
+    """
+    df = df_largo.copy()
+    df["frecuencia"] = pd.to_numeric(df["frecuencia"], errors="coerce").fillna(0).astype(int)
+    df = df[df["frecuencia"] > 0]
+    if df.empty:
+        return df.assign(porcentaje=0.0, acumulado=0, pct_acum=0.0,
+                         segmento_real="20%", segmento="80%").reset_index(drop=True)
+    # Orden estable por frecuencia y luego por nombre: dentro de cada nombre los empates
+    # conservan el orden de entrada, igual que calcular_pareto.
+    df = df.sort_values("frecuencia", ascending=False, kind="stable")
+    df = df.sort_values("nombre", kind="stable")
+    grupos = df.groupby("nombre", sort=False)["frecuencia"]
+    total = grupos.transform("sum")
+    df["porcentaje"] = (df["frecuencia"] / total * 100).round(2)
+    df["acumulado"]  = grupos.cumsum()
+    df["pct_acum"]   = (df["acumulado"] / total * 100).round(2)
+    df["segmento_real"] = np.where(df["pct_acum"] <= 80.00, "80%", "20%")
+    df["segmento"] = "80%"
+    return df.reset_index(drop=True)
+
+
+def separar_paretos(df_lote: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """Parte el resultado de calcular_paretos_lote en un DataFrame por nombre (forma de calcular_pareto)."""
+    if df_lote.empty:
+        return {}
+    # El lote viene ordenado por nombre: basta con cortar en los cambios de nombre
+    nombres = df_lote["nombre"].to_numpy()
+    cortes = np.r_[0, np.flatnonzero(nombres[1:] != nombres[:-1]) + 1, len(nombres)]
+    cuerpo = df_lote.drop(columns="nombre")
+    return {nombres[a]: cuerpo.iloc[a:b].reset_index(drop=True) for a, b in zip(cortes[:-1], cortes[1:])}
+
+
+# --- Paretos agregados por categoría / tema ---
+NIVELES_AGREGADO = {"categoria": "Categoría", "tema": "Tema"}
+
+
+def pareto_agregado(df_par: pd.DataFrame, nivel: str) -> pd.DataFrame:
+    """
+    Pareto de un Pareto (individual o unificado) agrupado por 'categoria' o 'tema'.
+    La columna 'descriptor' lleva la etiqueta del grupo, así gráfico, tabla y PDF
+    se reutilizan sin cambios.
+    """
+    if df_par.empty:
+        return calcular_pareto(pd.DataFrame(columns=["descriptor", "frecuencia"]))
+    if nivel == "categoria":
+        grupos = INDICE.categorias_de(df_par["descriptor"])
+    else:
+        grupos = INDICE.temas_de(df_par["descriptor"]).str.capitalize()
+    df = (pd.DataFrame({"descriptor": grupos.to_numpy(), "frecuencia": df_par["frecuencia"].to_numpy()})
+          .groupby("descriptor", sort=False, as_index=False)["frecuencia"].sum())
+    return calcular_pareto(df)
+
+
+# --- Portafolio columnar indexado por el catálogo ---
+DESCRIPTORES_CATALOGO: Tuple[str, ...] = INDICE.descriptores
+
+
+class PortafolioMatricial(MutableMapping):
+    """
+    Portafolio como matriz int32 Paretos × descriptores del catálogo, más un desborde
+    por Pareto para descriptores de texto libre que no están en el catálogo.
+    Para el resto de la app se comporta como Dict[str, Dict[str, int]]; resúmenes,
+    el formato largo y el agregado unificado son operaciones NumPy sobre filas.
+    """
+
+    def __init__(self, datos: Optional[Dict[str, Dict[str, int]]] = None):
+        self._m = np.zeros((0, len(DESCRIPTORES_CATALOGO)), dtype=np.int32)
+        self._fila: Dict[str, int] = {}        # nombre -> fila (y orden de inserción)
+        self._nombres: List[str] = []          # fila -> nombre
+        self._extra: Dict[str, Dict[str, int]] = {}
+        self._version = 0                      # sube con cada alta/cambio/baja
+        # Agregado unificado mantenido incrementalmente (ver unificado())
+        self._unif_sel: Dict[str, None] = {}
+        self._unif_suma = np.zeros(len(DESCRIPTORES_CATALOGO), dtype=np.int64)
+        self._unif_extra: Dict[str, int] = {}
+        self._unif_memo: Optional[Tuple[Tuple[tuple, int], MapaFrecuencias]] = None
+        if datos:
+            self.update(datos)
+
+    # --- interfaz de diccionario ---
+    def __len__(self) -> int:
+        return len(self._fila)
+
+    def __iter__(self):
+        return iter(self._fila)
+
+    def __contains__(self, nombre) -> bool:
+        return nombre in self._fila
+
+    def __getitem__(self, nombre: str) -> MapaFrecuencias:
+        fila = self._m[self._fila[nombre]]
+        cols = np.flatnonzero(fila)
+        extra = self._extra.get(nombre, {})
+        return MapaFrecuencias(
+            tuple(DESCRIPTORES_CATALOGO[j] for j in cols) + tuple(extra),
+            np.concatenate([fila[cols].astype(np.int64), np.fromiter(extra.values(), dtype=np.int64)]),
+        )
+
+    def __setitem__(self, nombre: str, freq_map: Dict[str, int]):
+        mapa = normalizar_freq_map(freq_map)
+        fila = self._fila.get(nombre)
+        en_unif = nombre in self._unif_sel
+        if en_unif:
+            self._unif_sumar(nombre, -1)
+        if fila is None:
+            fila = len(self._nombres)
+            if fila == self._m.shape[0]:
+                crecida = np.zeros((max(8, 2 * fila), self._m.shape[1]), dtype=np.int32)
+                crecida[:fila] = self._m
+                self._m = crecida
+            self._fila[nombre] = fila
+            self._nombres.append(nombre)
+        else:
+            self._m[fila] = 0
+        extra = {}
+        for d, f in mapa.items():
+            j = INDICE.buscar(d)  # variantes de tildes/mayúsculas/espacios caen en la columna del catálogo
+            if j is None:
+                d = str(d).strip()
+                extra[d] = extra.get(d, 0) + f
+            else:
+                self._m[fila, j] += f
+        if extra:
+            self._extra[nombre] = extra
+        else:
+            self._extra.pop(nombre, None)
+        if en_unif:
+            self._unif_sumar(nombre, +1)
+        self._version += 1
+
+    def __delitem__(self, nombre: str):
+        if nombre in self._unif_sel:
+            self._unif_sumar(nombre, -1)
+            del self._unif_sel[nombre]
+        fila = self._fila.pop(nombre)
+        ultima = len(self._nombres) - 1
+        if fila != ultima:  # la última fila ocupa el hueco; el orden visible lo da _fila
+            movido = self._nombres[ultima]
+            self._m[fila] = self._m[ultima]
+            self._nombres[fila] = movido
+            self._fila[movido] = fila
+        self._m[ultima] = 0
+        self._nombres.pop()
+        self._extra.pop(nombre, None)
+        self._version += 1
+
+    # --- reducciones ---
+    def _filas(self, nombres: Optional[List[str]]) -> np.ndarray:
+        if nombres is None:
+            return np.arange(len(self._nombres))
+        return np.fromiter((self._fila[n] for n in nombres if n in self._fila), dtype=np.intp)
+
+    def _unif_sumar(self, nombre: str, signo: int):
+        self._unif_suma += signo * self._m[self._fila[nombre]]
+        for d, f in self._extra.get(nombre, {}).items():
+            v = self._unif_extra.get(d, 0) + signo * f
+            if v:
+                self._unif_extra[d] = v
+            else:
+                self._unif_extra.pop(d, None)
+
+    def unificado(self, seleccion: List[str]) -> MapaFrecuencias:
+        """
+        Mapa unificado de la selección. Se mantiene un agregado vivo: al cambiar la
+        selección solo se suman/restan los Paretos que entraron o salieron, y guardar o
+        eliminar un Pareto seleccionado ajusta solo su fila. Misma selección y misma
+        versión del portafolio devuelven el mismo objeto (memo).
+        """
+        clave = (tuple(seleccion), self._version)
+        if self._unif_memo is not None and self._unif_memo[0] == clave:
+            return self._unif_memo[1]
+        pedidos = dict.fromkeys(n for n in seleccion if n in self._fila)
+        for n in [n for n in self._unif_sel if n not in pedidos]:
+            self._unif_sumar(n, -1)
+            del self._unif_sel[n]
+        for n in pedidos:
+            if n not in self._unif_sel:
+                self._unif_sumar(n, +1)
+                self._unif_sel[n] = None
+        cols = np.flatnonzero(self._unif_suma)
+        mapa = MapaFrecuencias(
+            tuple(DESCRIPTORES_CATALOGO[j] for j in cols) + tuple(self._unif_extra),
+            np.concatenate([self._unif_suma[cols],
+                            np.fromiter(self._unif_extra.values(), dtype=np.int64)]),
+        )
+        self._unif_memo = (clave, mapa)
+        return mapa
+
+    def resumen(self, nombre: str) -> Dict[str, int]:
+        """Cantidad de descriptores y total de respuestas del Pareto, sin reconstruir el diccionario."""
+        fila = self._m[self._fila[nombre]]
+        extra = self._extra.get(nombre, {})
+        return {"descriptores": int(np.count_nonzero(fila)) + len(extra),
+                "total": int(fila.sum(dtype=np.int64)) + sum(extra.values())}
+
+    def largo(self, nombres: Optional[List[str]] = None) -> pd.DataFrame:
+        """Formato largo (nombre, descriptor, categoria, frecuencia) para calcular_paretos_lote."""
+        nombres = list(self._fila) if nombres is None else [n for n in nombres if n in self._fila]
+        filas = self._filas(nombres)
+        sub = self._m[filas]
+        i, j = np.nonzero(sub)
+        df = pd.DataFrame({
+            "nombre": np.asarray(nombres, dtype=object)[i] if len(i) else np.array([], dtype=object),
+            "descriptor": np.asarray(DESCRIPTORES_CATALOGO, dtype=object)[j],
+            "frecuencia": sub[i, j].astype(int),
+        })
+        extra = [(n, d, f) for n in nombres for d, f in self._extra.get(n, {}).items()]
+        if extra:
+            df = pd.concat([df, pd.DataFrame(extra, columns=["nombre", "descriptor", "frecuencia"])],
+                           ignore_index=True)
+        df.insert(2, "categoria", INDICE.categorias_de(df["descriptor"]))
+        return df
+
+
 def _colors_for_segments(segments: List[str]) -> List[str]:
     return [VERDE if s == "80%" else AZUL for s in segments]
 
@@ -312,7 +718,7 @@ def _wrap_labels(labels: List[str], width: int = 22) -> List[str]:
         width = 18
     elif len(labels) > 12:
         width = 20
-    return ["\n".join(wrap(str(t), width=width)) for t in labels]
+    return [INDICE.etiqueta(t, width) for t in labels]
 # ============================================================================
 # ============================== PARTE 4/10 =================================
 # ====== Gráfico Pareto (UI) + Exportación Excel con gráfico combinado ======
@@ -340,11 +746,216 @@ def _wrap_for_two_lines(labels: List[str]) -> List[str]:
         wrapped.append("\n".join(parts))
     return wrapped
 
-def dibujar_pareto(df_par: pd.DataFrame, titulo: str):
-    if df_par.empty:
-        st.info("Ingresa frecuencias (>0) para ver el gráfico.")
-        return
+# --- Capa de render: toda figura se crea y se libera aquí ---
+class _EstadisticasRender:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.renders = 0
+        self.errores = 0
+        self.vivas = 0
 
+    def abrir(self):
+        with self._lock:
+            self.vivas += 1
+
+    def cerrar(self, ok: bool):
+        with self._lock:
+            self.vivas -= 1
+            if ok:
+                self.renders += 1
+            else:
+                self.errores += 1
+
+
+@st.cache_resource(show_spinner=False)
+def _estadisticas_render() -> _EstadisticasRender:
+    return _EstadisticasRender()
+
+
+def _estilar_ejes(ax):
+    """Aplica ESTILO_GRAFICOS a unos ejes: grid, tamaños de ticks y de etiquetas."""
+    ax.grid(True, alpha=ESTILO_GRAFICOS["grid_alpha"])
+    ax.tick_params(axis="x", labelsize=ESTILO_GRAFICOS["xticks"])
+    ax.tick_params(axis="y", labelsize=ESTILO_GRAFICOS["yticks"])
+    ax.xaxis.label.set_fontsize(ESTILO_GRAFICOS["etiquetas"])
+    ax.yaxis.label.set_fontsize(ESTILO_GRAFICOS["etiquetas"])
+    return ax
+
+
+@contextmanager
+def _figura(figsize: Tuple[float, float], dpi: Optional[float] = None):
+    """
+    Crea (fig, ax) sobre un lienzo Agg propio, sin pasar por pyplot: la figura no entra
+    en ningún registro global, así que varias sesiones pueden dibujar a la vez.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    est = _estadisticas_render()
+    fig = Figure(figsize=figsize, dpi=dpi or ESTILO_GRAFICOS["dpi"])
+    FigureCanvasAgg(fig)
+    est.abrir()
+    ok = False
+    try:
+        ax = _estilar_ejes(fig.add_subplot())
+        yield fig, ax
+        ok = True
+    finally:
+        fig.clear()
+        est.cerrar(ok)
+
+
+def _render_png(dibujar, figsize: Tuple[float, float], dpi: float, **savefig_kw) -> bytes:
+    """Ejecuta dibujar(fig, ax) sobre una figura nueva y devuelve el PNG; la figura no sobrevive."""
+    with _figura(figsize, dpi) as (fig, ax):
+        dibujar(fig, ax)
+        buf = io.BytesIO()
+        fig.savefig(buf, format="PNG", dpi=dpi, **savefig_kw)
+    return buf.getvalue()
+
+
+def estadisticas_render() -> Dict[str, float]:
+    """Renders hechos, figuras abiertas en este momento y RSS pico del proceso."""
+    est = _estadisticas_render()
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource else float("nan")
+    return {"renders": est.renders, "errores": est.errores,
+            "figuras_vivas": est.vivas, "rss_pico_mb": rss_mb}
+
+
+# --- Caché de gráficos renderizados (direccionada por contenido) ---
+class _CacheGraficos:
+    """
+    PNGs por hash del contenido (Pareto calculado/título/tipo/dpi), compartidos
+    entre sesiones. LRU acotada por bytes totales; opcionalmente respaldada en
+    disco para sobrevivir reinicios del proceso. El directorio respeta el mismo
+    presupuesto: se borran los archivos de mtime más antiguo (cada acierto lo renueva).
+    """
+
+    def __init__(self, max_bytes: int, directorio: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.directorio = directorio
+        self._lock = threading.Lock()
+        self._datos: "OrderedDict[str, bytes]" = OrderedDict()
+        self._bytes = 0
+        self.aciertos = 0
+        self.aciertos_disco = 0
+        self.fallos = 0
+        self._lock_disco = threading.Lock()
+        self._bytes_disco = 0
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+            with self._lock_disco:
+                self._recortar_disco()
+
+    def _ruta(self, clave: str) -> str:
+        return os.path.join(self.directorio, f"{clave}.png")
+
+    def obtener(self, clave: str) -> Optional[bytes]:
+        with self._lock:
+            png = self._datos.get(clave)
+            if png is not None:
+                self._datos.move_to_end(clave)
+                self.aciertos += 1
+                return png
+        png = self._leer_disco(clave) if self.directorio else None
+        if png is not None:
+            self._guardar_memoria(clave, png)
+            with self._lock:
+                self.aciertos_disco += 1
+            return png
+        with self._lock:
+            self.fallos += 1
+        return None
+
+    def guardar(self, clave: str, png: bytes):
+        self._guardar_memoria(clave, png)
+        if self.directorio:
+            tmp = self._ruta(clave) + ".tmp"
+            with open(tmp, "wb") as fh:
+                fh.write(png)
+            os.replace(tmp, self._ruta(clave))
+            with self._lock_disco:
+                self._bytes_disco += len(png)
+                if self._bytes_disco > self.max_bytes:
+                    self._recortar_disco()
+
+    def _leer_disco(self, clave: str) -> Optional[bytes]:
+        ruta = self._ruta(clave)
+        try:
+            with open(ruta, "rb") as fh:
+                png = fh.read()
+        except FileNotFoundError:  # nunca guardado, o recortado (quizá por otro proceso)
+            return None
+        try:
+            os.utime(ruta)
+        except OSError:
+            pass
+        return png
+
+    def _recortar_disco(self):
+        """Recalcula el tamaño del directorio y borra los PNG más antiguos hasta volver al presupuesto."""
+        archivos: List[Tuple[float, int, str]] = []
+        with os.scandir(self.directorio) as it:
+            for e in it:
+                if not e.name.endswith(".png"):
+                    continue
+                try:
+                    info = e.stat()
+                except FileNotFoundError:
+                    continue
+                archivos.append((info.st_mtime, info.st_size, e.path))
+        total = sum(tam for _, tam, _ in archivos)
+        for _, tam, ruta in sorted(archivos):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(ruta)
+            except FileNotFoundError:
+                pass
+            total -= tam
+        self._bytes_disco = total
+
+    def _guardar_memoria(self, clave: str, png: bytes):
+        with self._lock:
+            if clave in self._datos:
+                self._bytes -= len(self._datos.pop(clave))
+            self._datos[clave] = png
+            self._bytes += len(png)
+            while self._bytes > self.max_bytes and len(self._datos) > 1:
+                _, viejo = self._datos.popitem(last=False)
+                self._bytes -= len(viejo)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.aciertos + self.aciertos_disco + self.fallos
+            return {"entradas": len(self._datos), "bytes": self._bytes,
+                    "bytes_disco": self._bytes_disco,
+                    "aciertos": self.aciertos, "aciertos_disco": self.aciertos_disco,
+                    "fallos": self.fallos,
+                    "tasa_acierto": (self.aciertos + self.aciertos_disco) / total if total else 0.0}
+
+
+@st.cache_resource(show_spinner=False)
+def _cache_graficos() -> _CacheGraficos:
+    return _CacheGraficos(GRAFICOS_CACHE_MAX_BYTES, GRAFICOS_CACHE_DIR)
+
+
+def _grafico_cacheado(clave: str, generar) -> bytes:
+    """Devuelve el PNG de 'clave' o lo genera con 'generar()' y lo guarda."""
+    cache = _cache_graficos()
+    png = cache.obtener(clave)
+    if png is None:
+        png = generar()
+        cache.guardar(clave, png)
+    return png
+
+
+PREVIEW_MODO = "interactivo"  # "interactivo" (Plotly, se dibuja en el navegador) | "imagen" (PNG Matplotlib)
+PREVIEW_DPI = 200      # mismo dpi que usaba st.pyplot para la vista previa
+MODALIDADES_DPI = 220  # igual que el Pareto del PDF
+
+
+def _pareto_preview_png(df_par: pd.DataFrame, titulo: str) -> bytes:
     n_labels = len(df_par)
     x        = np.arange(n_labels)
     freqs    = df_par["frecuencia"].to_numpy()
@@ -356,29 +967,99 @@ def dibujar_pareto(df_par: pd.DataFrame, titulo: str):
     fig_w = max(12.0, 0.60 * n_labels)
     fs    = 9 if n_labels > 28 else 10
 
-    fig, ax1 = plt.subplots(figsize=(fig_w, 6.6))
-    ax1.bar(x, freqs, color=colors_b)
-    ax1.set_ylabel("Frecuencia")
-    ax1.set_xticks(x)
-    ax1.set_xticklabels(labels_w, rotation=90, ha="center", va="top", fontsize=fs)
-    fig.subplots_adjust(bottom=0.30)
+    def _dibujar(fig, ax1):
+        ax1.bar(x, freqs, color=colors_b)
+        ax1.set_ylabel("Frecuencia")
+        ax1.set_xticks(x)
+        ax1.set_xticklabels(labels_w, rotation=90, ha="center", va="top", fontsize=fs)
+        fig.subplots_adjust(bottom=0.30)
+
+        ax1.set_title(titulo if titulo.strip() else "Diagrama de Pareto", color=TEXTO, fontsize=16)
 
-    ax1.set_title(titulo if titulo.strip() else "Diagrama de Pareto", color=TEXTO, fontsize=16)
+        ax2 = _estilar_ejes(ax1.twinx())
+        ax2.plot(x, pct_acum, marker="o", linewidth=2, color=TEXTO)
+        ax2.set_ylabel("% acumulado")
+        ax2.set_ylim(0, 110)
 
-    ax2 = ax1.twinx()
-    ax2.plot(x, pct_acum, marker="o", linewidth=2, color=TEXTO)
-    ax2.set_ylabel("% acumulado")
-    ax2.set_ylim(0, 110)
+        if (df_par["segmento_real"] == "80%").any():
+            cut_idx = np.where(df_par["segmento_real"].to_numpy() == "80%")[0].max()
+            ax1.axvline(cut_idx + 0.5, linestyle=":", color="k")
+        ax2.axhline(80, linestyle="--", linewidth=1, color="#666666")
 
-    if (df_par["segmento_real"] == "80%").any():
-        cut_idx = np.where(df_par["segmento_real"].to_numpy() == "80%")[0].max()
-        ax1.axvline(cut_idx + 0.5, linestyle=":", color="k")
-    ax2.axhline(80, linestyle="--", linewidth=1, color="#666666")
+        fig.tight_layout()
 
-    fig.tight_layout()
-    st.pyplot(fig)
+    return _render_png(_dibujar, figsize=(fig_w, 6.6), dpi=PREVIEW_DPI, bbox_inches="tight")
 
 
+def _pareto_preview_plotly(df_par: pd.DataFrame, titulo: str) -> "go.Figure":
+    """
+    Misma lectura que el PNG (barras por segmento, % acumulado en eje secundario,
+    corte del 80%) pero como especificación Plotly: el navegador dibuja y hace zoom.
+    """
+    import plotly.graph_objects as go
+
+    n_labels = len(df_par)
+    x        = np.arange(n_labels)
+    segs     = df_par["segmento_real"].to_numpy()
+    labels   = [str(t) for t in df_par["descriptor"].tolist()]
+    ticks    = [l.replace("\n", "<br>") for l in _wrap_for_two_lines(labels)]
+
+    fig = go.Figure()
+    fig.add_bar(
+        x=x, y=df_par["frecuencia"].to_numpy(),
+        marker_color=_colors_for_segments(segs.tolist()),
+        customdata=labels, name="Frecuencia",
+        hovertemplate="%{customdata}<br>Frecuencia: %{y}<extra></extra>",
+    )
+    fig.add_scatter(
+        x=x, y=df_par["pct_acum"].to_numpy(), yaxis="y2", name="% acumulado",
+        mode="lines+markers", line=dict(color=TEXTO, width=2),
+        customdata=labels, hovertemplate="%{customdata}<br>% acumulado: %{y:.2f}%<extra></extra>",
+    )
+    fig.add_hline(y=80, yref="y2", line_dash="dash", line_width=1, line_color="#666666")
+    if (segs == "80%").any():
+        cut_idx = int(np.where(segs == "80%")[0].max())
+        fig.add_vline(x=cut_idx + 0.5, line_dash="dot", line_color="black")
+
+    fig.update_layout(
+        title=dict(text=titulo if titulo.strip() else "Diagrama de Pareto", font=dict(color=TEXTO, size=18)),
+        xaxis=dict(tickmode="array", tickvals=x, ticktext=ticks, tickangle=-90,
+                   tickfont=dict(size=9 if n_labels > 28 else 10)),
+        yaxis=dict(title="Frecuencia"),
+        yaxis2=dict(title="% acumulado", overlaying="y", side="right", range=[0, 110], showgrid=False),
+        showlegend=False, bargap=0.2, height=560,
+        margin=dict(l=10, r=10, t=50, b=10),
+    )
+    return fig
+
+
+def dibujar_pareto(df_par: pd.DataFrame, titulo: str):
+    if df_par.empty:
+        st.info("Ingresa frecuencias (>0) para ver el gráfico.")
+        return
+    if PREVIEW_MODO == "interactivo":
+        st.plotly_chart(_pareto_preview_plotly(df_par, titulo), width="stretch")
+        return
+    clave = _firma_pareto(df_par, titulo, "preview", PREVIEW_DPI)
+    st.image(_grafico_cacheado(clave, lambda: _pareto_preview_png(df_par, titulo)))
+
+
+def ui_paretos_agregados(df_par: pd.DataFrame, titulo: str, key: str):
+    """Pareto por categoría y por tema; se calcula solo cuando el usuario lo abre."""
+    if df_par.empty or not st.toggle("Ver Pareto por categoría y por tema", key=f"agr_{key}"):
+        return
+    pestanas = st.tabs([f"Por {e.lower()}" for e in NIVELES_AGREGADO.values()])
+    for pestana, (nivel, etiqueta) in zip(pestanas, NIVELES_AGREGADO.items()):
+        with pestana:
+            df_n = pareto_agregado(df_par, nivel)
+            dibujar_pareto(df_n, f"{titulo} · por {etiqueta.lower()}")
+            st.dataframe(
+                df_n[["descriptor", "frecuencia", "porcentaje", "pct_acum"]]
+                .rename(columns={"descriptor": etiqueta, "frecuencia": "Frecuencia",
+                                 "porcentaje": "%", "pct_acum": "% acumulado"}),
+                hide_index=True, width="stretch",
+            )
+
 
 def exportar_excel_con_grafico(df_par: pd.DataFrame, titulo: str) -> bytes:
     output = io.BytesIO()
@@ -448,6 +1129,48 @@ def exportar_excel_con_grafico(df_par: pd.DataFrame, titulo: str) -> bytes:
     return output.getvalue()
 
 
+# --- Exportaciones bajo demanda (fuera del camino de cada tecla) ---
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def _firma_pareto(df_par: pd.DataFrame, *extra) -> str:
+    """
+    Hash estable del Pareto calculado (descriptor, frecuencia, % acumulado, segmento) + extras.
+    El % acumulado entra en la llave porque un tramo paginado conserva el acumulado
+    global: dos Paretos distintos pueden tener un tramo con las mismas filas y título.
+    """
+    h = hashlib.sha1()
+    if not df_par.empty:
+        cols = df_par[["descriptor", "frecuencia", "pct_acum", "segmento_real"]].astype(str)
+        h.update(pd.util.hash_pandas_object(cols, index=False).to_numpy().tobytes())
+    for e in extra:
+        h.update(b"\x1f" + str(e).encode("utf-8"))
+    return h.hexdigest()
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _excel_memo(df_par: pd.DataFrame, titulo: str) -> bytes:
+    return exportar_excel_con_grafico(df_par, titulo)
+
+
+def ui_descarga_excel(df_par: pd.DataFrame, titulo: str, file_name: str, key: str,
+                      etiqueta: str = "📥 Exportar Excel con gráfico"):
+    """
+    Preparar → descargar: el xlsx se genera solo al pedirlo y queda memoizado por
+    (contenido del Pareto, título); si el Pareto cambia, vuelve a pedirse.
+    La sesión guarda solo el último xlsx preparado: volver a preparar otro Pareto
+    ya generado lo sirve _excel_memo sin recalcular.
+    """
+    firma = _firma_pareto(df_par, titulo)
+    listo = st.session_state.get("xlsx_listo")
+    if not listo or listo[:2] != (key, firma):
+        if not st.button("⚙️ Preparar Excel con gráfico", key=f"prep_xlsx_{key}"):
+            return
+        listo = (key, firma, _excel_memo(df_par, titulo))
+        st.session_state["xlsx_listo"] = listo
+    st.download_button(etiqueta, listo[2], file_name=file_name, mime=XLSX_MIME, key=f"dl_xlsx_{key}")
+
+
 # ============================================================================
 # ============================== PARTE 5/10 =================================
 # ======================== Conectores Google Sheets (gspread) ================
@@ -458,73 +1181,793 @@ SCOPES = [
     "https://www.googleapis.com/auth/drive"
 ]
 
+# --- Capa de acceso: presupuesto de cuota + reintentos con backoff ---
+class SheetsLimitado(RuntimeError):
+    """Google Sheets sigue respondiendo 429 (cuota agotada) tras agotar los reintentos."""
+
+
+_CODIGOS_REINTENTABLES = {429, 500, 502, 503, 504}
+
+
+class _PresupuestoSheets:
+    """Token bucket por proceso: como máximo 'por_minuto' solicitudes por minuto."""
+
+    def __init__(self, por_minuto: int):
+        self.capacidad = float(por_minuto)
+        self.tasa = por_minuto / 60.0
+        self._fichas = self.capacidad
+        self._t = time.monotonic()
+        self._lock = threading.Lock()
+        self.llamadas = 0
+        self.reintentos = 0
+        self.limitadas = 0
+        self.espera_seg = 0.0
+
+    def tomar(self):
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self._fichas = min(self.capacidad, self._fichas + (ahora - self._t) * self.tasa)
+                self._t = ahora
+                if self._fichas >= 1:
+                    self._fichas -= 1
+                    self.llamadas += 1
+                    return
+                espera = (1 - self._fichas) / self.tasa
+                self.espera_seg += espera
+            time.sleep(espera)
+
+    def registrar_fallo(self, codigo: int):
+        with self._lock:
+            self.reintentos += 1
+            if codigo == 429:
+                # el servidor ya nos limitó: vaciar el balde frena también a los demás hilos
+                self.limitadas += 1
+                self._fichas = 0.0
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {"llamadas": self.llamadas, "reintentos": self.reintentos,
+                    "limitadas": self.limitadas, "espera_seg": round(self.espera_seg, 1)}
+
+
+@st.cache_resource(show_spinner=False)
+def _presupuesto_sheets() -> _PresupuestoSheets:
+    return _PresupuestoSheets(SHEETS_CUOTA_POR_MIN)
+
+
+def _codigo_api(e: Exception) -> Optional[int]:
+    from gspread.exceptions import APIError
+
+    if isinstance(e, APIError):
+        return getattr(e, "code", None) or e.response.status_code
+    return None
+
+
+def _api(fn, *args, **kwargs):
+    """
+    Toda llamada a la API de Sheets pasa por aquí: consume presupuesto y
+    reintenta 429/5xx con backoff exponencial con jitter.
+    """
+    return _api_llamar(fn, args, kwargs, _CODIGOS_REINTENTABLES)
+
+
+def _api_mutacion(fn, *args, **kwargs):
+    """
+    Para escrituras no idempotentes (append, borrado de filas por índice): solo se
+    reintenta 429, que garantiza que la solicitud no se aplicó. Un 5xx puede llegar
+    después de que Google ya escribió, y repetirla duplicaría filas.
+    """
+    return _api_llamar(fn, args, kwargs, {429})
+
+
+def _api_llamar(fn, args, kwargs, reintentables):
+    from gspread.exceptions import APIError
+
+    pres = _presupuesto_sheets()
+    for intento in range(SHEETS_MAX_REINTENTOS + 1):
+        pres.tomar()
+        try:
+            return fn(*args, **kwargs)
+        except APIError as e:
+            codigo = _codigo_api(e)
+            if codigo not in reintentables:
+                raise
+            pres.registrar_fallo(codigo)
+            if intento == SHEETS_MAX_REINTENTOS:
+                if codigo == 429:
+                    raise SheetsLimitado(
+                        "Google Sheets está limitando las solicitudes (cuota por minuto agotada)."
+                    ) from e
+                raise
+            tope = min(SHEETS_BACKOFF_MAX_SEG, SHEETS_BACKOFF_BASE_SEG * 2 ** intento)
+            time.sleep(random.uniform(tope / 2, tope))
+
+class _ConexionSheets:
+    """
+    Cliente gspread autorizado y handles de hojas/pestañas, compartidos por
+    todas las sesiones. El token se renueva cuando vence; el encabezado de
+    cada pestaña se verifica una sola vez (leyendo solo la fila 1).
+    '_lock' solo protege los diccionarios: las llamadas de red (y sus esperas de
+    backoff) ocurren fuera, con un candado por handle para no abrir dos veces
+    lo mismo sin frenar a quien usa otros handles ya abiertos.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lock_token = threading.Lock()
+        self._creds = None
+        self._gc = None
+        self._generacion = 0
+        self._hojas: Dict[str, object] = {}
+        self._pestanas: Dict[Tuple[str, str], object] = {}
+        self._abriendo: Dict[object, threading.Lock] = {}
+
+    def cliente(self):
+        import gspread
+        from google.auth.transport.requests import Request
+        from google.oauth2.service_account import Credentials
+
+        with self._lock:
+            gc, creds = self._gc, self._creds
+        if gc is None:
+            creds = Credentials.from_service_account_info(
+                st.secrets["gcp_service_account"],
+                scopes=SCOPES
+            )
+            gc = gspread.authorize(creds)
+            with self._lock:
+                if self._gc is None:
+                    self._gc, self._creds = gc, creds
+                gc, creds = self._gc, self._creds
+        if creds.expired:
+            with self._lock_token:
+                if creds.expired:
+                    creds.refresh(Request())
+        return gc
+
+    def _obtener(self, cache: Dict, clave, abrir):
+        """Handle de 'cache' o, si falta, lo abre fuera de '_lock' (doble verificación)."""
+        with self._lock:
+            obj = cache.get(clave)
+            if obj is not None:
+                return obj
+            lock_clave = self._abriendo.setdefault(clave, threading.Lock())
+        with lock_clave:
+            with self._lock:
+                obj, generacion = cache.get(clave), self._generacion
+            if obj is None:
+                obj = abrir()
+                with self._lock:
+                    if generacion == self._generacion:  # no revivir handles descartados por olvidar()
+                        cache[clave] = obj
+        return obj
+
+    def hoja(self, url: str):
+        gc = self.cliente()
+        return self._obtener(self._hojas, url, lambda: _api(gc.open_by_url, url))
+
+    def pestana(self, sh, title: str, header: List[str]):
+        return self._obtener(self._pestanas, (sh.id, title), lambda: _verificar_ws(sh, title, header))
+
+    def olvidar(self):
+        """Descarta handles (p. ej. tras 401/404) para reconstruirlos en el próximo uso."""
+        with self._lock:
+            self._gc = None
+            self._generacion += 1
+            self._hojas.clear()
+            self._pestanas.clear()
+
+
+@st.cache_resource(show_spinner=False)
+def _conexion_sheets() -> _ConexionSheets:
+    return _ConexionSheets()
+
+
+def _olvidar_si_handle_invalido(e: Exception):
+    from gspread.exceptions import APIError
+
+    if isinstance(e, APIError) and e.response.status_code in (401, 404):
+        _conexion_sheets().olvidar()
+
+
 def _gc():
-    creds = Credentials.from_service_account_info(
-        st.secrets["gcp_service_account"],
-        scopes=SCOPES
-    )
-    return gspread.authorize(creds)
+    return _conexion_sheets().cliente()
 
 
-def _open_sheet():
-    gc = _gc()
-    return gc.open_by_url(SPREADSHEET_URL)
+def _open_sheet(url: str = SPREADSHEET_URL):
+    return _conexion_sheets().hoja(url)
 
 
 def _ensure_ws(sh, title: str, header: List[str]):
+    return _conexion_sheets().pestana(sh, title, header)
+
+
+def _verificar_ws(sh, title: str, header: List[str]):
+    from gspread.exceptions import WorksheetNotFound
+
     try:
-        ws = sh.worksheet(title)
-    except gspread.exceptions.WorksheetNotFound:
-        ws = sh.add_worksheet(title=title, rows=1000, cols=max(10, len(header)))
-        ws.append_row(header)
+        ws = _api(sh.worksheet, title)
+    except WorksheetNotFound:
+        ws = _api_mutacion(sh.add_worksheet, title=title, rows=1000, cols=max(10, len(header)))
+        _api_mutacion(ws.append_row, header)
         return ws
 
-    values = ws.get_all_values()
-    if not values:
-        ws.append_row(header)
-    else:
-        first = values[0]
-        if [c.strip().lower() for c in first] != [c.strip().lower() for c in header]:
-            ws.clear()
-            ws.append_row(header)
+    first = _api(ws.row_values, 1)
+    if not first:
+        _api_mutacion(ws.append_row, header)
+    elif [c.strip().lower() for c in first[:len(header)]] != [c.strip().lower() for c in header]:
+        # (celdas a la derecha del encabezado, como LOG_TURNO_CELDA, no cuentan)
+        # limpiar y reescribir el encabezado en una sola solicitud
+        _api(sh.batch_update, {"requests": [
+            {"updateCells": {"range": {"sheetId": ws.id}, "fields": "userEnteredValue"}},
+            {"updateCells": {"range": {"sheetId": ws.id, "startRowIndex": 0, "endRowIndex": 1},
+                             "rows": [{"values": [_celda(c) for c in header]}],
+                             "fields": "userEnteredValue"}},
+        ]})
     return ws
 
 
-def sheets_cargar_portafolio() -> Dict[str, Dict[str, int]]:
-    """Lee 'paretos' (nombre, descriptor, frecuencia). Ignora vacíos y <=0."""
+HEADER_PARETOS = ["nombre", "descriptor", "frecuencia"]
+
+
+class _IndiceFragmentos:
+    """
+    nombre -> índice en FRAGMENTOS; los nombres nuevos se asignan por prefijo.
+    'completo' indica que ya se registraron los dueños de todos los fragmentos
+    (lectura completa o lectura de metadatos): antes de eso, el respaldo por
+    prefijo podría mandar una escritura a un fragmento que no es el dueño.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._duenos: Dict[str, int] = {}
+        self.completo = len(FRAGMENTOS) == 1  # con un solo fragmento no hay a quién preguntar
+
+    def registrar(self, duenos: Dict[str, int], completo: bool = False):
+        with self._lock:
+            for nom, i in duenos.items():
+                self._duenos.setdefault(nom.strip().lower(), i)
+            if completo:
+                self.completo = True
+
+    def dueno(self, nombre: str) -> int:
+        clave = nombre.strip().lower()
+        with self._lock:
+            if clave not in self._duenos:
+                self._duenos[clave] = next(
+                    (i for i, f in enumerate(FRAGMENTOS)
+                     if any(clave.startswith(p.strip().lower()) for p in f.get("prefijos", []))),
+                    0)
+            return self._duenos[clave]
+
+    def agrupar(self, lote: Dict) -> Dict[int, Dict]:
+        grupos: Dict[int, Dict] = {}
+        for nombre, valor in lote.items():
+            grupos.setdefault(self.dueno(nombre), {})[nombre] = valor
+        return grupos
+
+
+@st.cache_resource(show_spinner=False)
+def _indice_fragmentos() -> _IndiceFragmentos:
+    return _IndiceFragmentos()
+
+
+def _indice_fragmentos_completo() -> _IndiceFragmentos:
+    """
+    Índice de dueños listo para escribir. Si aún no hubo una lectura completa
+    (p. ej. modo "sqlite" recién reiniciado con la base existente), lee solo la
+    columna de nombres de cada fragmento (y del log) y registra los dueños.
+    """
+    indice = _indice_fragmentos()
+    if indice.completo:
+        return indice
+
+    def _nombres_fragmento(frag: Dict) -> List[str]:
+        sh = _open_sheet(frag["url"])
+        nombres = _api(_ensure_ws(sh, frag["ws"], HEADER_PARETOS).col_values, 1)[1:]
+        if MODO_ALMACEN == "log":
+            nombres += _api(_ensure_ws(sh, frag.get("log", WS_LOG), HEADER_LOG).col_values, 2)[1:]
+        return nombres
+
+    with ThreadPoolExecutor(max_workers=min(FRAGMENTOS_MAX_HILOS, len(FRAGMENTOS))) as pool:
+        listas = list(pool.map(_nombres_fragmento, FRAGMENTOS))
+    duenos: Dict[str, int] = {}
+    for i, nombres in enumerate(listas):  # en orden: el primer fragmento que lo tiene es el dueño
+        for nom in nombres:
+            if str(nom).strip():
+                duenos.setdefault(str(nom), i)
+    indice.registrar(duenos, completo=True)
+    return indice
+
+
+class _CachePortafolio:
+    """
+    Portafolio parseado compartido por todas las sesiones del proceso.
+    Protegido con lock; expira tras 'ttl' segundos o al invalidarse tras escribir.
+    Una sola lectura de Sheets a la vez (single-flight): las sesiones que llegan
+    durante una carga esperan y reutilizan su resultado.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._carga = threading.Lock()
+        self._datos: Dict[str, Dict[str, int]] = {}
+        self._cargado_en = 0.0       # monotonic del *inicio* de la lectura vigente
+        self._invalidado_en = 0.0
+        self._vigente = False
+        self.aciertos = 0
+        self.fallos = 0
+        self.lecturas = 0
+
+    def obtener(self):
+        """Copia del portafolio si está vigente; None si hay que leer Sheets."""
+        with self._lock:
+            if self._vigente and (time.monotonic() - self._cargado_en) < self.ttl:
+                self.aciertos += 1
+                return {n: dict(m) for n, m in self._datos.items()}
+            self.fallos += 1
+            return None
+
+    def guardar(self, port: Dict[str, Dict[str, int]], leido_en: float):
+        """Publica una lectura iniciada en 'leido_en'; no queda vigente si se invalidó después."""
+        with self._lock:
+            self._datos = {n: dict(m) for n, m in port.items()}
+            self._cargado_en = leido_en
+            self._vigente = self._invalidado_en < leido_en
+
+    def invalidar(self):
+        with self._lock:
+            self._vigente = False
+            self._invalidado_en = time.monotonic()
+
+    def cargar(self, leer, forzar: bool = False) -> Dict[str, Dict[str, int]]:
+        """
+        Portafolio vigente o, si no hay, el resultado de 'leer(leido_en)'. Si otra sesión
+        ya está leyendo, espera y reutiliza esa lectura cuando empezó después del pedido
+        (también con 'forzar').
+        """
+        pedido_en = time.monotonic()
+        if not forzar:
+            port = self.obtener()
+            if port is not None:
+                return port
+        with self._carga:
+            with self._lock:
+                fresca = self._vigente and self._cargado_en >= pedido_en
+                if fresca or (not forzar and self._vigente
+                              and time.monotonic() - self._cargado_en < self.ttl):
+                    return {n: dict(m) for n, m in self._datos.items()}
+            leido_en = time.monotonic()
+            port = leer(leido_en)
+            self.lecturas += 1
+            self.guardar(port, leido_en)
+            return port
+
+    def aplicar(self, nombre: str, freq_map: Optional[Dict[str, int]]):
+        """Refleja un guardado (o eliminación si None) sin releer Sheets."""
+        with self._lock:
+            if not self._vigente:
+                return
+            if freq_map:
+                self._datos[nombre] = dict(freq_map)
+            else:
+                self._datos.pop(nombre, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"aciertos": self.aciertos, "fallos": self.fallos, "lecturas": self.lecturas,
+                    "paretos": len(self._datos) if self._vigente else 0}
+
+
+@st.cache_resource(show_spinner=False)
+def _cache_portafolio(url: str) -> _CachePortafolio:
+    """Una instancia por proceso (y por URL de Sheets), compartida entre sesiones."""
+    return _CachePortafolio(PORTAFOLIO_TTL_SEG)
+
+
+def sheets_cargar_portafolio(forzar: bool = False, progreso=None) -> Dict[str, Dict[str, int]]:
+    """
+    Portafolio desde la caché compartida; si expiró (o 'forzar'), relee Sheets.
+    Los errores de lectura (incluido SheetsLimitado) se propagan: un portafolio
+    vacío significa que la hoja está vacía. 'progreso(n_filas)' es opcional.
+    """
+    if ALMACEN_PRIMARIO == "sqlite":
+        return _local_cargar_portafolio(progreso=progreso)
+
+    def _leer(leido_en: float) -> Dict[str, Dict[str, int]]:
+        port = _sheets_leer_portafolio(progreso=progreso)
+        # escrituras pendientes y las que terminaron mientras se leía
+        _cola_escritura(SPREADSHEET_URL).superponer(port, desde=leido_en)
+        return port
+
+    return _cache_portafolio(SPREADSHEET_URL).cargar(_leer, forzar=forzar)
+
+
+def _freq_entera(v) -> int:
     try:
-        sh = _open_sheet()
-        ws = _ensure_ws(sh, WS_PARETOS, ["nombre", "descriptor", "frecuencia"])
-        rows = ws.get_all_records()
+        return int(float(str(v).strip() or 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _iter_bloques(ws, n_cols: int, bloque: int = LECTURA_BLOQUE_FILAS, progreso=None):
+    """
+    Generador de bloques de filas de datos (sin encabezado) leídos por rangos A1
+    de 'bloque' filas: en memoria solo vive un bloque a la vez.
+    'progreso(n_filas_leidas)' se llama tras cada bloque; el consumidor puede
+    cortar la iteración en cualquier momento.
+    """
+    ultima_col = chr(ord("A") + n_cols - 1)
+    leidas = 0
+    # La API recorta las filas vacías del final de *cada rango*: un bloque corto no
+    # significa fin de hoja (basta una fila en blanco en el borde). El límite es el
+    # tamaño de la grilla; más allá solo se sigue mientras lleguen bloques llenos
+    # (handle con row_count desactualizado por escrituras de otro proceso).
+    limite = int(getattr(ws, "row_count", 0) or 0)
+    inicio = 2
+    while True:
+        fin = inicio + bloque - 1
+        filas = _api(ws.get, f"A{inicio}:{ultima_col}{fin}", value_render_option="UNFORMATTED_VALUE")
+        leidas += len(filas)
+        yield filas
+        if progreso:
+            progreso(leidas)
+        if fin >= limite and len(filas) < bloque:
+            return
+        inicio = fin + 1
+
+
+def _iter_filas(ws, n_cols: int, **kwargs):
+    """Como _iter_bloques, pero fila por fila."""
+    for filas in _iter_bloques(ws, n_cols, **kwargs):
+        yield from filas
+
+
+def _df_portafolio(filas) -> pd.DataFrame:
+    """
+    Filas crudas (nombre, descriptor, frecuencia) -> DataFrame largo agregado.
+    Coerción de 'frecuencia', filtrado de vacíos/<=0 y suma de pares
+    (nombre, descriptor) repetidos en pasadas vectorizadas.
+    """
+    df = pd.DataFrame(list(filas)).reindex(columns=range(3))
+    df.columns = ["nombre", "descriptor", "frecuencia"]
+    for c in ("nombre", "descriptor"):
+        df[c] = df[c].fillna("").astype(str).str.strip()
+    df["frecuencia"] = pd.to_numeric(df["frecuencia"], errors="coerce").fillna(0).astype("int64")
+    df = df[(df["nombre"] != "") & (df["descriptor"] != "") & (df["frecuencia"] > 0)]
+    # Variantes de escritura de un descriptor del catálogo se agregan bajo su forma canónica
+    df = df.assign(descriptor=df["descriptor"].map({d: INDICE.canonico(d) for d in pd.unique(df["descriptor"])}))
+    return df.groupby(["nombre", "descriptor"], sort=False, as_index=False)["frecuencia"].sum()
+
+
+def _portafolio_desde_df(df: pd.DataFrame) -> Dict[str, MapaFrecuencias]:
+    port: Dict[str, Dict[str, int]] = {}
+    for nom, desc, f in zip(df["nombre"].tolist(), df["descriptor"].tolist(), df["frecuencia"].tolist()):
+        port.setdefault(nom, {})[desc] = int(f)
+    # _df_portafolio ya validó y agregó: se envuelve sin volver a normalizar
+    return {nom: MapaFrecuencias.de_enteros(m) for nom, m in port.items()}
+
+
+def _leer_ws_df(ws, progreso=None) -> pd.DataFrame:
+    """
+    Lee una pestaña de Paretos por bloques y devuelve el formato largo agregado
+    (nombre, descriptor, frecuencia). Cada bloque se agrega apenas llega,
+    así que la memoria depende de los pares distintos y no del tamaño de la hoja.
+    """
+    parciales = [_df_portafolio(bl) for bl in _iter_bloques(ws, 3, progreso=progreso)]
+    df = pd.concat(parciales, ignore_index=True) if parciales else _df_portafolio([])
+    if len(parciales) > 1:
+        df = df.groupby(["nombre", "descriptor"], sort=False, as_index=False)["frecuencia"].sum()
+    return df
+
+
+def _sheets_leer_fragmento(frag: Dict, progreso=None) -> Dict[str, Dict[str, int]]:
+    sh = _open_sheet(frag["url"])
+    ws = _ensure_ws(sh, frag["ws"], HEADER_PARETOS)
+    port = _portafolio_desde_df(_leer_ws_df(ws, progreso=progreso))
+    if MODO_ALMACEN == "log":
+        ws_log = _ensure_ws(sh, frag.get("log", WS_LOG), HEADER_LOG)
+        _log_plegar(port, _iter_filas(ws_log, 5))
+    return port
+
+
+def _sheets_leer_portafolio(progreso=None) -> Dict[str, Dict[str, int]]:
+    """
+    Lee todos los fragmentos (en paralelo si hay más de uno) y los combina.
+    Registra a qué fragmento pertenece cada nombre para dirigir las escrituras.
+    """
+    try:
+        if len(FRAGMENTOS) == 1:
+            partes = [(0, _sheets_leer_fragmento(FRAGMENTOS[0], progreso))]
+        else:
+            partes = []
+            with ThreadPoolExecutor(max_workers=min(FRAGMENTOS_MAX_HILOS, len(FRAGMENTOS))) as pool:
+                futuros = {pool.submit(_sheets_leer_fragmento, f): i
+                           for i, f in enumerate(FRAGMENTOS)}
+                for fut in as_completed(futuros):
+                    partes.append((futuros[fut], fut.result()))
+                    if progreso:  # se informa desde el hilo del script, no desde el pool
+                        progreso(sum(len(m) for _, p in partes for m in p.values()))
         port: Dict[str, Dict[str, int]] = {}
-        for r in rows:
-            nom = str(r.get("nombre", "")).strip()
-            desc = str(r.get("descriptor", "")).strip()
-            freq = int(pd.to_numeric(r.get("frecuencia", 0), errors="coerce") or 0)
-            if not nom or not desc or freq <= 0:
-                continue
-            bucket = port.setdefault(nom, {})
-            bucket[desc] = bucket.get(desc, 0) + freq
+        duenos: Dict[str, int] = {}
+        for i, parte in sorted(partes, key=lambda x: x[0]):
+            for nom, mapa in parte.items():
+                # Un nombre repetido en otro fragmento es una copia huérfana: manda la del
+                # dueño (el primer fragmento), que es donde van las escrituras. No se suman.
+                if nom not in duenos:
+                    duenos[nom] = i
+                    port[nom] = mapa
+        _indice_fragmentos().registrar(duenos, completo=True)
         return port
+    except Exception as e:
+        _olvidar_si_handle_invalido(e)
+        raise
+
+
+def _celda(v) -> Dict:
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        return {"userEnteredValue": {"numberValue": v}}
+    return {"userEnteredValue": {"stringValue": str(v)}}
+
+
+def _rangos_contiguos(indices: List[int]) -> List[Tuple[int, int]]:
+    """[3,4,5,9] -> [(3,6), (9,10)]  (fin exclusivo)."""
+    rangos: List[Tuple[int, int]] = []
+    for i in sorted(indices):
+        if rangos and rangos[-1][1] == i:
+            rangos[-1] = (rangos[-1][0], i + 1)
+        else:
+            rangos.append((i, i + 1))
+    return rangos
+
+
+def _filas_por_nombre(col_nombres: List[str]) -> Dict[str, List[int]]:
+    """Índices 0-based de las filas de cada nombre (la fila 0 es el encabezado)."""
+    out: Dict[str, List[int]] = {}
+    for i, v in enumerate(col_nombres[1:], start=1):
+        k = str(v).strip().lower()
+        if k:
+            out.setdefault(k, []).append(i)
+    return out
+
+
+def _sheets_aplicar_cambios(ws, cambios: Dict[str, Optional[Dict[str, int]]]) -> int:
+    """
+    Upsert por nombre en un único batch_update.
+    'cambios': nombre -> freq_map (guardar) o None (eliminar).
+    Lee solo la columna A y las filas de los nombres afectados; reescribe en sitio
+    las celdas que cambiaron, borra los rangos sobrantes y agrega las filas nuevas.
+    Retorna la cantidad de filas eliminadas.
+    """
+    col_nombres = _api(ws.col_values, 1)
+    filas = _filas_por_nombre(col_nombres)
+
+    # Valores actuales solo de las filas que se van a reescribir
+    pos_guardar = sorted(i for n, m in cambios.items() if m is not None
+                         for i in filas.get(n.strip().lower(), []))
+    actuales: Dict[int, List[str]] = {}
+    if pos_guardar:
+        rangos = _rangos_contiguos(pos_guardar)
+        bloques = _api(ws.batch_get, [f"A{a + 1}:C{b}" for a, b in rangos])
+        for (a, _b), bloque in zip(rangos, bloques):
+            for k, fila in enumerate(bloque):
+                actuales[a + k] = [str(c).strip() for c in fila]
+
+    sid = ws.id
+    reqs: List[Dict] = []
+    borrar: List[int] = []
+    nuevas: List[List] = []
+    for nombre, freq_map in cambios.items():
+        pos = filas.get(nombre.strip().lower(), [])
+        if freq_map is None:
+            borrar.extend(pos)
+            continue
+        rows_new = [[nombre, d, int(f)] for d, f in normalizar_freq_map(freq_map).items()]
+        for i, fila in zip(pos, rows_new):
+            if actuales.get(i, []) != [str(c) for c in fila]:
+                reqs.append({"updateCells": {
+                    "range": {"sheetId": sid, "startRowIndex": i, "endRowIndex": i + 1,
+                              "startColumnIndex": 0, "endColumnIndex": 3},
+                    "rows": [{"values": [_celda(c) for c in fila]}],
+                    "fields": "userEnteredValue",
+                }})
+        borrar.extend(pos[len(rows_new):])
+        nuevas.extend(rows_new[len(pos):])
+
+    # Borrados de abajo hacia arriba para no desplazar índices pendientes
+    for a, b in reversed(_rangos_contiguos(borrar)):
+        reqs.append({"deleteDimension": {"range": {
+            "sheetId": sid, "dimension": "ROWS", "startIndex": a, "endIndex": b}}})
+    if nuevas:
+        reqs.append({"appendCells": {
+            "sheetId": sid,
+            "rows": [{"values": [_celda(c) for c in fila]} for fila in nuevas],
+            "fields": "userEnteredValue",
+        }})
+    if reqs:
+        _api_mutacion(ws.spreadsheet.batch_update, {"requests": reqs})
+    return len(borrar)
+
+
+# --- Modo "log": eventos append-only + compactación ---
+HEADER_LOG = ["timestamp", "nombre", "op", "descriptor", "frecuencia"]
+_lock_compactacion = threading.Lock()
+
+
+def _log_plegar(port: Dict[str, Dict[str, int]], filas: List[List[str]]):
+    """
+    Aplica eventos del log, en orden, sobre 'port'.
+    Las filas de un mismo guardado comparten timestamp: la primera reemplaza
+    el Pareto completo y las siguientes lo completan. El timestamp identifica el
+    lote: una fila (timestamp, nombre, op, descriptor) repetida es una copia del
+    mismo append y se ignora, así un lote escrito dos veces no duplica frecuencias.
+    """
+    version: Dict[str, str] = {}
+    vistas = set()
+    for fila in filas:
+        ts, nom, op, desc, freq = (list(fila) + [""] * 5)[:5]
+        nom, desc, op = str(nom).strip(), str(desc).strip(), str(op).strip()
+        if not nom:
+            continue
+        clave = (str(ts), nom, op, desc)
+        if clave in vistas:
+            continue
+        vistas.add(clave)
+        if op == "eliminar":
+            port.pop(nom, None)
+            version.pop(nom, None)
+            continue
+        if op == "guardar" and version.get(nom) != ts:
+            port[nom] = {}
+            version[nom] = ts
+        f = _freq_entera(freq)
+        if desc and f > 0:
+            bucket = port.setdefault(nom, {})
+            bucket[desc] = bucket.get(desc, 0) + f
+    for nom in [n for n, m in port.items() if not m]:
+        del port[nom]
+
+
+def _log_registrar(sh, frag: Dict, lote: Dict[str, Optional[Dict[str, int]]],
+                   op_guardar: str = "guardar") -> int:
+    """Un único append_rows con los eventos del lote; compacta si el log creció demasiado."""
+    ts = datetime.now().isoformat(timespec="microseconds")
+    rows: List[List] = []
+    for nombre, freq_map in lote.items():
+        if freq_map is None:
+            rows.append([ts, nombre, "eliminar", "", ""])
+            continue
+        mapa = normalizar_freq_map(freq_map)
+        rows += [[ts, nombre, op_guardar, d, int(f)] for d, f in mapa.items()]
+        if not mapa:
+            rows.append([ts, nombre, op_guardar, "", 0])
+    ws_log = _ensure_ws(sh, frag.get("log", WS_LOG), HEADER_LOG)
+    resp = _api_mutacion(ws_log.append_rows, rows, value_input_option="RAW")
+    # updatedRange: "paretos_log!A120:E125" -> última fila escrita
+    rango = str((resp or {}).get("updates", {}).get("updatedRange", ""))
+    ultima = rango.rsplit(":", 1)[-1].lstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+    if ultima.isdigit() and int(ultima) - 1 > LOG_MAX_FILAS:
+        _log_compactar(sh, frag)
+    return sum(1 for m in lote.values() if m is None)
+
+
+def _log_tomar_turno(ws_log) -> Optional[str]:
+    """
+    Intenta tomar el turno de compactación de la hoja (LOG_TURNO_CELDA).
+    Sheets no tiene escritura condicional: se escribe el token propio, se espera
+    y se relee; si otra réplica escribió después, gana ella. Retorna el token o None.
+    """
+    def _leer() -> Tuple[str, float]:
+        valor = _api(ws_log.get, LOG_TURNO_CELDA, value_render_option="UNFORMATTED_VALUE")
+        token, _, vence = str(valor[0][0] if valor and valor[0] else "").partition("|")
+        try:
+            return token, float(vence)
+        except ValueError:
+            return "", 0.0
+
+    token, vence = _leer()
+    if token and vence > time.time():
+        return None
+    propio = os.urandom(8).hex()
+    _api(ws_log.update, [[f"{propio}|{time.time() + LOG_TURNO_SEG:.0f}"]], LOG_TURNO_CELDA,
+         value_input_option="RAW")
+    time.sleep(1.0)
+    return propio if _leer()[0] == propio else None
+
+
+def _log_soltar_turno(ws_log, token: str):
+    """Libera el turno si sigue siendo propio (si falla, vence solo)."""
+    try:
+        valor = _api(ws_log.get, LOG_TURNO_CELDA)
+        if valor and valor[0] and str(valor[0][0]).startswith(token + "|"):
+            _api(ws_log.update, [[""]], LOG_TURNO_CELDA, value_input_option="RAW")
     except Exception:
-        return {}
+        pass
+
+
+def _log_compactar(sh, frag: Dict):
+    """
+    Pliega el log sobre la pestaña 'paretos', la reescribe como snapshot y
+    borra del log exactamente el rango de filas plegado (lo que llegue mientras
+    tanto se conserva). Entre réplicas compacta solo quien tiene el turno de la hoja.
+    """
+    if not _lock_compactacion.acquire(blocking=False):
+        return
+    try:
+        ws = _ensure_ws(sh, frag["ws"], HEADER_PARETOS)
+        ws_log = _ensure_ws(sh, frag.get("log", WS_LOG), HEADER_LOG)
+        token = _log_tomar_turno(ws_log)
+        if token is None:
+            return
+        try:
+            # Todo evento lleva timestamp: la columna A fija el rango a plegar (filas 2..ultima),
+            # contando también las filas en blanco intermedias
+            col_ts = _api(ws_log.col_values, 1)
+            ultima = len(col_ts)
+            if ultima < 2:
+                return
+            eventos = [f for a in range(2, ultima + 1, LECTURA_BLOQUE_FILAS)
+                       for f in _api(ws_log.get, f"A{a}:E{min(a + LECTURA_BLOQUE_FILAS - 1, ultima)}",
+                                     value_render_option="UNFORMATTED_VALUE")]
+            port = _portafolio_desde_df(_df_portafolio(_iter_filas(ws, 3)))
+            _log_plegar(port, eventos)
+            filas = [[n, d, int(f)] for n, m in port.items() for d, f in m.items()]
+            # Si el turno venció y otra réplica compactó, las filas ya no están donde se leyeron
+            if _api(ws_log.col_values, 1)[:ultima] != col_ts:
+                return
+            # snapshot nuevo + recorte del log en un único batch_update
+            _api_mutacion(sh.batch_update, {"requests": [
+                {"updateCells": {"range": {"sheetId": ws.id}, "fields": "userEnteredValue"}},
+                {"appendCells": {"sheetId": ws.id,
+                                 "rows": [{"values": [_celda(c) for c in fila]}
+                                          for fila in [HEADER_PARETOS] + filas],
+                                 "fields": "userEnteredValue"}},
+                {"deleteDimension": {"range": {"sheetId": ws_log.id, "dimension": "ROWS",
+                                               "startIndex": 1, "endIndex": ultima}}},
+            ]})
+        finally:
+            _log_soltar_turno(ws_log, token)
+    finally:
+        _lock_compactacion.release()
+
+
+def _sheets_escribir(lote: Dict[str, Optional[Dict[str, int]]]) -> int:
+    """
+    Punto único de escritura: reparte el lote por fragmento dueño y aplica
+    MODO_ALMACEN en cada uno. Retorna filas/eventos de eliminación.
+    """
+    eliminadas = 0
+    for i, sublote in _indice_fragmentos_completo().agrupar(lote).items():
+        frag = FRAGMENTOS[i]
+        sh = _open_sheet(frag["url"])
+        if MODO_ALMACEN == "log":
+            eliminadas += _log_registrar(sh, frag, sublote)
+        else:
+            eliminadas += _sheets_aplicar_cambios(_ensure_ws(sh, frag["ws"], HEADER_PARETOS), sublote)
+    return eliminadas
 
 
 def sheets_guardar_pareto(nombre: str, freq_map: Dict[str, int], sobrescribir: bool = True):
-    """Guarda filas válidas. Si 'sobrescribir', elimina solo las filas del mismo nombre."""
-    sh = _open_sheet()
-    ws = _ensure_ws(sh, WS_PARETOS, ["nombre", "descriptor", "frecuencia"])
+    """Guarda filas válidas. Si 'sobrescribir', reemplaza solo las filas del mismo nombre."""
+    if ALMACEN_PRIMARIO == "sqlite":
+        almacen = _almacen_local(SQLITE_RUTA)
+        if sobrescribir:
+            almacen.guardar(nombre, normalizar_freq_map(freq_map))
+        else:
+            almacen.sumar(nombre, normalizar_freq_map(freq_map))
+    frag = FRAGMENTOS[_indice_fragmentos_completo().dueno(nombre)]
     if sobrescribir:
-        vals = ws.get_all_values()
-        header = vals[0] if vals else ["nombre", "descriptor", "frecuencia"]
-        others = [r for r in vals[1:] if (len(r) > 0 and r[0].strip().lower() != nombre.strip().lower())]
-        ws.clear()
-        ws.update("A1", [header])
-        if others:
-            ws.append_rows(others, value_input_option="RAW")
-    rows_new = [[nombre, d, int(f)] for d, f in normalizar_freq_map(freq_map).items()]
-    if rows_new:
-        ws.append_rows(rows_new, value_input_option="RAW")
+        _sheets_escribir({nombre: freq_map})
+    elif MODO_ALMACEN == "log":
+        _log_registrar(_open_sheet(frag["url"]), frag, {nombre: freq_map}, op_guardar="sumar")
+    else:
+        ws = _ensure_ws(_open_sheet(frag["url"]), frag["ws"], HEADER_PARETOS)
+        rows_new = [[nombre, d, int(f)] for d, f in normalizar_freq_map(freq_map).items()]
+        if rows_new:
+            _api_mutacion(ws.append_rows, rows_new, value_input_option="RAW")
+    _cache_portafolio(SPREADSHEET_URL).invalidar()
 
 
 def sheets_eliminar_pareto(nombre: str) -> bool:
@@ -533,21 +1976,278 @@ def sheets_eliminar_pareto(nombre: str) -> bool:
     Retorna True si se eliminaron filas.
     """
     try:
-        sh = _open_sheet()
-        ws = _ensure_ws(sh, WS_PARETOS, ["nombre", "descriptor", "frecuencia"])
-        vals = ws.get_all_values()
-        if not vals or len(vals) <= 1:
-            return False
-        header = vals[0]
-        others = [r for r in vals[1:] if (len(r) > 0 and r[0].strip().lower() != nombre.strip().lower())]
-        ws.clear()
-        ws.update("A1", [header])
-        if others:
-            ws.append_rows(others, value_input_option="RAW")
-        return True
+        if ALMACEN_PRIMARIO == "sqlite":
+            _almacen_local(SQLITE_RUTA).guardar(nombre, None)
+        eliminadas = _sheets_escribir({nombre: None})
+        _cache_portafolio(SPREADSHEET_URL).invalidar()
+        return eliminadas > 0
     except Exception as e:
         st.warning(f"No se pudo eliminar '{nombre}' de Google Sheets: {e}")
         return False
+# --- Escritura diferida (write-behind) ---
+class _ColaEscritura:
+    """
+    Cola de escrituras a Sheets vaciada por un hilo de fondo.
+    Los cambios por nombre se fusionan (el último gana) y cada ventana de
+    ESCRITURA_VENTANA_SEG se envía en un solo batch_update. Lo que falla
+    vuelve a la cola y se reintenta con espera creciente; como la cola vive
+    a nivel de proceso, sobrevive a los reruns de Streamlit.
+    """
+    RETENCION_SEG = 900  # cuánto se recuerda una escritura ya hecha (más que cualquier lectura)
+
+    def __init__(self, cache: "_CachePortafolio"):
+        self._cache = cache
+        self._cond = threading.Condition()
+        self._pendientes: Dict[str, Optional[Dict[str, int]]] = {}
+        self._en_vuelo: Dict[str, Optional[Dict[str, int]]] = {}
+        # nombre -> (monotonic al terminar de escribirse, valor escrito)
+        self._escritos: Dict[str, Tuple[float, Optional[Dict[str, int]]]] = {}
+        self._reintentos: Dict[str, int] = {}
+        self._despertar = False
+        self.ultimo_error = ""
+        self._hilo = threading.Thread(target=self._trabajar, name="sheets-write-behind", daemon=True)
+        self._hilo.start()
+
+    def encolar(self, nombre: str, freq_map: Optional[Dict[str, int]]):
+        """freq_map=None equivale a eliminar el Pareto."""
+        with self._cond:
+            self._pendientes[nombre] = dict(freq_map) if freq_map is not None else None
+            self._cond.notify()
+        self._cache.aplicar(nombre, freq_map)
+
+    def reintentar(self):
+        with self._cond:
+            self._despertar = True
+            self._cond.notify()
+
+    def superponer(self, port: Dict[str, Dict[str, int]], desde: Optional[float] = None):
+        """
+        Aplica sobre una lectura de Sheets los cambios aún no escritos y, si se indica
+        'desde' (monotonic del inicio de la lectura), también los que terminaron de
+        escribirse después: la lectura pudo no verlos.
+        """
+        with self._cond:
+            limite = time.monotonic() - self.RETENCION_SEG
+            self._escritos = {n: v for n, v in self._escritos.items() if v[0] >= limite}
+            escritos = {} if desde is None else \
+                {n: m for n, (t, m) in self._escritos.items() if t >= desde}
+            cambios = {**escritos, **self._en_vuelo, **self._pendientes}
+        for nombre, freq_map in cambios.items():
+            if freq_map:
+                port[nombre] = dict(freq_map)
+            else:
+                port.pop(nombre, None)
+
+    def estado(self) -> Dict:
+        with self._cond:
+            nombres = set(self._pendientes) | set(self._en_vuelo)
+            return {"pendientes": len(nombres),
+                    "fallidos": sum(1 for n in nombres if self._reintentos.get(n)),
+                    "error": self.ultimo_error}
+
+    def _trabajar(self):
+        while True:
+            with self._cond:
+                while not self._pendientes:
+                    self._cond.wait()
+            time.sleep(ESCRITURA_VENTANA_SEG)  # deja que se acumulen guardados cercanos
+            with self._cond:
+                self._en_vuelo, self._pendientes = self._pendientes, {}
+                lote = self._en_vuelo
+            try:
+                _sheets_escribir_lote(lote)
+            except Exception as e:
+                with self._cond:
+                    for nombre, freq_map in lote.items():
+                        # si llegó un cambio más nuevo mientras tanto, ese gana
+                        self._pendientes.setdefault(nombre, freq_map)
+                        self._reintentos[nombre] = self._reintentos.get(nombre, 0) + 1
+                    self._en_vuelo = {}
+                    self.ultimo_error = str(e) or e.__class__.__name__
+                    n = max(self._reintentos[k] for k in lote)
+                    self._despertar = False
+                    self._cond.wait_for(lambda: self._despertar,
+                                        timeout=ESCRITURA_REINTENTO_SEG * min(2 ** (n - 1), 16))
+                    self._despertar = False
+            else:
+                with self._cond:
+                    ahora = time.monotonic()
+                    for nombre, freq_map in lote.items():
+                        self._reintentos.pop(nombre, None)
+                        self._escritos[nombre] = (ahora, freq_map)
+                    self._en_vuelo = {}
+                    if not any(self._reintentos.get(n) for n in self._pendientes):
+                        self.ultimo_error = ""
+
+
+@st.cache_resource(show_spinner=False)
+def _cola_escritura(url: str) -> _ColaEscritura:
+    return _ColaEscritura(_cache_portafolio(url))
+
+
+def _sheets_escribir_lote(lote: Dict[str, Optional[Dict[str, int]]]):
+    """Escribe un lote fusionado de guardados/eliminaciones (sin llamadas a st.*)."""
+    try:
+        _sheets_escribir(lote)
+    except Exception as e:
+        _olvidar_si_handle_invalido(e)
+        raise
+
+
+def sheets_guardar_pareto_diferido(nombre: str, freq_map: Dict[str, int]):
+    """Actualiza el almacén/caché al instante y deja la escritura a Sheets en cola."""
+    mapa = normalizar_freq_map(freq_map)
+    if ALMACEN_PRIMARIO == "sqlite":
+        _almacen_local(SQLITE_RUTA).guardar(nombre, mapa)
+    _cola_escritura(SPREADSHEET_URL).encolar(nombre, mapa)
+
+
+def sheets_eliminar_pareto_diferido(nombre: str):
+    if ALMACEN_PRIMARIO == "sqlite":
+        _almacen_local(SQLITE_RUTA).guardar(nombre, None)
+    _cola_escritura(SPREADSHEET_URL).encolar(nombre, None)
+
+
+# --- Almacén local primario (SQLite) + sincronización con Sheets ---
+class _AlmacenLocal:
+    """
+    Portafolio en SQLite indexado por (nombre, descriptor). Guardados y
+    eliminaciones son transaccionales; Sheets queda como espejo/sistema de registro.
+    """
+
+    def __init__(self, ruta: str):
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(ruta, check_same_thread=False)
+        self._escrito_en: Dict[str, float] = {}
+        with self._lock, self._con:
+            self._con.execute("PRAGMA journal_mode=WAL")
+            self._con.execute("""
+                CREATE TABLE IF NOT EXISTS paretos (
+                    nombre     TEXT    NOT NULL,
+                    descriptor TEXT    NOT NULL,
+                    frecuencia INTEGER NOT NULL CHECK (frecuencia > 0),
+                    PRIMARY KEY (nombre, descriptor)
+                )""")
+            self._con.execute("CREATE TABLE IF NOT EXISTS meta (clave TEXT PRIMARY KEY, valor TEXT)")
+
+    def cargar(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            filas = self._con.execute(
+                "SELECT nombre, descriptor, frecuencia FROM paretos ORDER BY rowid").fetchall()
+        port: Dict[str, Dict[str, int]] = {}
+        for nom, desc, f in filas:
+            port.setdefault(nom, {})[desc] = f
+        return port
+
+    def sumar(self, nombre: str, freq_map: Dict[str, int]):
+        """Suma frecuencias al Pareto (crea los descriptores que no tenga)."""
+        with self._lock, self._con:
+            self._con.executemany(
+                "INSERT INTO paretos (nombre, descriptor, frecuencia) VALUES (?, ?, ?) "
+                "ON CONFLICT (nombre, descriptor) DO UPDATE SET frecuencia = frecuencia + excluded.frecuencia",
+                [(nombre, d, int(f)) for d, f in freq_map.items()])
+            self._escrito_en[nombre] = time.monotonic()
+
+    def guardar(self, nombre: str, freq_map: Optional[Dict[str, int]]) -> int:
+        """Reemplaza el Pareto completo (None = eliminar). Retorna filas eliminadas."""
+        with self._lock, self._con:
+            borradas = self._con.execute("DELETE FROM paretos WHERE nombre = ?", (nombre,)).rowcount
+            if freq_map:
+                self._con.executemany(
+                    "INSERT INTO paretos (nombre, descriptor, frecuencia) VALUES (?, ?, ?)",
+                    [(nombre, d, int(f)) for d, f in freq_map.items()])
+            self._escrito_en[nombre] = time.monotonic()
+        return borradas
+
+    def reemplazar_todo(self, port: Dict[str, Dict[str, int]], leido_en: float):
+        """
+        Vuelca una lectura de Sheets hecha en 'leido_en' (monotonic). Los nombres
+        escritos localmente después de esa lectura conservan su versión local.
+        """
+        with self._lock, self._con:
+            recientes = {n for n, t in self._escrito_en.items() if t >= leido_en}
+            locales = self._con.execute(
+                "SELECT nombre, descriptor, frecuencia FROM paretos WHERE nombre IN (%s)"
+                % ",".join("?" * len(recientes)), tuple(recientes)).fetchall() if recientes else []
+            self._con.execute("DELETE FROM paretos")
+            self._con.executemany(
+                "INSERT INTO paretos (nombre, descriptor, frecuencia) VALUES (?, ?, ?)",
+                [(n, d, int(f)) for n, m in port.items() if n not in recientes for d, f in m.items()]
+                + locales)
+            self._con.execute("INSERT OR REPLACE INTO meta (clave, valor) VALUES ('ultima_sync', ?)",
+                              (datetime.now().isoformat(timespec="seconds"),))
+            self._escrito_en = {n: t for n, t in self._escrito_en.items() if t >= leido_en}
+
+    def sincronizado(self) -> bool:
+        with self._lock:
+            return self._con.execute("SELECT 1 FROM meta WHERE clave = 'ultima_sync'").fetchone() is not None
+
+
+@st.cache_resource(show_spinner=False)
+def _almacen_local(ruta: str) -> _AlmacenLocal:
+    return _AlmacenLocal(ruta)
+
+
+def _sincronizar_desde_sheets(almacen: _AlmacenLocal, cola: "_ColaEscritura", progreso=None):
+    """Pull: Sheets -> SQLite, respetando los cambios locales aún no escritos en Sheets."""
+    leido_en = time.monotonic()
+    port = _sheets_leer_portafolio(progreso=progreso)
+    cola.superponer(port, desde=leido_en)
+    almacen.reemplazar_todo(port, leido_en)
+
+
+@st.cache_resource(show_spinner=False)
+def _sincronizador(ruta: str, url: str) -> threading.Thread:
+    """Hilo de fondo que refresca el almacén local desde Sheets cada SYNC_INTERVALO_SEG."""
+    almacen, cola = _almacen_local(ruta), _cola_escritura(url)
+
+    def _bucle():
+        while True:
+            time.sleep(SYNC_INTERVALO_SEG)
+            try:
+                _sincronizar_desde_sheets(almacen, cola)
+            except Exception:
+                pass  # se reintenta en el próximo ciclo; la app sigue sirviendo desde SQLite
+
+    hilo = threading.Thread(target=_bucle, name="sheets-pull-sync", daemon=True)
+    hilo.start()
+    return hilo
+
+
+def _local_cargar_portafolio(progreso=None) -> Dict[str, Dict[str, int]]:
+    almacen = _almacen_local(SQLITE_RUTA)
+    if not almacen.sincronizado():
+        # primera vez: importación completa desde Sheets (errores se propagan)
+        _sincronizar_desde_sheets(almacen, _cola_escritura(SPREADSHEET_URL), progreso=progreso)
+    _sincronizador(SQLITE_RUTA, SPREADSHEET_URL)
+    return almacen.cargar()
+
+
+def _fragmento_periodico(cada_seg: float):
+    """st.fragment(run_every=...) si existe; si no, la función se ejecuta solo en cada rerun."""
+    frag = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+    return frag(run_every=cada_seg) if frag else (lambda f: f)
+
+
+@_fragmento_periodico(ESTADO_SYNC_CADA_SEG)
+def ui_estado_sincronizacion():
+    """
+    Indicador de escrituras pendientes / fallidas hacia Google Sheets. Es un fragmento
+    que se vuelve a ejecutar solo: las interacciones dentro de las pestañas no
+    relanzan el script completo y el estado de la cola cambia en segundo plano.
+    """
+    cola = _cola_escritura(SPREADSHEET_URL)
+    est = cola.estado()
+    if est["fallidos"]:
+        c1, c2 = st.columns([4, 1])
+        with c1:
+            st.warning(f"⚠️ {est['fallidos']} cambio(s) no se pudieron guardar en Google Sheets; "
+                       f"se reintentará automáticamente. Último error: {est['error']}")
+        with c2:
+            if st.button("🔁 Reintentar ahora", key="sync_retry"):
+                cola.reintentar()
+    elif est["pendientes"]:
+        st.caption(f"⏳ {est['pendientes']} cambio(s) pendiente(s) de sincronizar con Google Sheets…")
 # ============================================================================
 # ============================== PARTE 6/10 =================================
 # =================== Estado de sesión + Estilos básicos PDF =================
@@ -555,7 +2255,9 @@ def sheets_eliminar_pareto(nombre: str) -> bool:
 
 # ---- Estado de sesión ----
 st.session_state.setdefault("freq_map", {})
-st.session_state.setdefault("portafolio", {})
+st.session_state.setdefault("portafolio", PortafolioMatricial())
+if not hasattr(st.session_state["portafolio"], "unificado"):  # sesiones previas (Dict u otra versión)
+    st.session_state["portafolio"] = PortafolioMatricial(st.session_state["portafolio"])
 st.session_state.setdefault("msel", [])
 st.session_state.setdefault("editor_df", pd.DataFrame(columns=["descriptor", "frecuencia"]))
 st.session_state.setdefault("last_msel", [])
@@ -564,12 +2266,27 @@ st.session_state.setdefault("reset_after_save", False)
 # NUEVO: si cambió la URL del Sheet, vaciar portafolio para no arrastrar datos viejos
 st.session_state.setdefault("sheet_url_loaded", None)
 if st.session_state["sheet_url_loaded"] != SPREADSHEET_URL:
-    st.session_state["portafolio"] = {}
+    st.session_state["portafolio"] = PortafolioMatricial()
     st.session_state["sheet_url_loaded"] = SPREADSHEET_URL
 
 # Cargar portafolio desde Sheets solo si está vacío
-if not st.session_state["portafolio"]:
-    loaded = sheets_cargar_portafolio()
+# (si la lectura falló no se reintenta en cada rerun: el usuario decide cuándo)
+st.session_state.setdefault("portafolio_error", None)
+if not st.session_state["portafolio"] and not st.session_state["portafolio_error"]:
+    _aviso_carga = st.empty()
+    try:
+        loaded = sheets_cargar_portafolio(
+            progreso=lambda n: _aviso_carga.caption(f"Cargando portafolio desde Google Sheets… {n} filas")
+        )
+    except SheetsLimitado as e:
+        loaded = {}
+        st.session_state["portafolio_error"] = (
+            f"{e} Tus Paretos siguen guardados; vuelve a intentar la carga en un minuto."
+        )
+    except Exception as e:
+        loaded = {}
+        st.session_state["portafolio_error"] = f"No se pudo leer el portafolio desde Google Sheets: {e}"
+    _aviso_carga.empty()
     if loaded:
         st.session_state["portafolio"].update(loaded)
 
@@ -583,10 +2300,12 @@ if st.session_state.get("reset_after_save", False):
     st.session_state["reset_after_save"] = False
 
 # ---- Estilos PDF / páginas ----
-PAGE_W, PAGE_H = A4
-
-
+@st.cache_resource(show_spinner=False)
 def _styles():
+    """Hoja de estilos del informe; se arma una vez por proceso (solo se lee al construir)."""
+    from reportlab.lib import colors
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+
     ss = getSampleStyleSheet()
     ss.add(ParagraphStyle(
         name="CoverTitle", fontName="Helvetica-Bold",
@@ -628,17 +2347,25 @@ def _styles():
 
 
 def _page_cover(canv, doc):
+    from reportlab.lib import colors
+    from reportlab.lib.units import cm
+
+    page_w, page_h = doc.pagesize
     canv.setFillColor(colors.HexColor(TEXTO))
-    canv.rect(0, PAGE_H - 0.9 * cm, PAGE_W, 0.9 * cm, fill=1, stroke=0)
+    canv.rect(0, page_h - 0.9 * cm, page_w, 0.9 * cm, fill=1, stroke=0)
 
 
 def _page_normal(_canv, _doc):
     pass
 
 
-def _page_last(canv, _doc):
+def _page_last(canv, doc):
+    from reportlab.lib import colors
+    from reportlab.lib.units import cm
+
+    page_w, _ = doc.pagesize
     canv.setFillColor(colors.HexColor(TEXTO))
-    canv.rect(0, 0, PAGE_W, 0.9 * cm, fill=1, stroke=0)
+    canv.rect(0, 0, page_w, 0.9 * cm, fill=1, stroke=0)
 # ============================================================================
 # ============================== PARTE 7/10 =================================
 # ============ Imágenes para PDF (Pareto/Modalidades) y textos helper =======
@@ -665,7 +2392,58 @@ def _wrap_for_two_lines(labels: List[str]) -> List[str]:
         result.append("\n".join(parts))
     return result
 
+PARETO_PDF_DPI = 220
+PARETO_ANCHO_MAX_PX = 6000    # tope de ancho del PNG del Pareto en el PDF
+PARETO_MODO_ANCHO = "otros"   # "otros" (top-N + barra «Otros») | "paginas" (tramos a ancho de página)
+PARETO_TOP_N = 40
+PARETO_POR_PAGINA = 30
+
+
+def _pareto_ancho_pulg(n_labels: int) -> float:
+    return max(12.0, 0.60 * n_labels)
+
+
+def _pareto_con_otros(df_par: pd.DataFrame, top_n: int) -> pd.DataFrame:
+    """
+    Conserva los top_n descriptores y agrupa el resto en una barra «Otros».
+    Las filas conservadas mantienen su % acumulado; «Otros» cierra en el total (100%).
+    """
+    if len(df_par) <= top_n:
+        return df_par
+    cabeza, resto = df_par.iloc[:top_n], df_par.iloc[top_n:]
+    otros = pd.DataFrame([{
+        "descriptor": f"Otros ({len(resto)} descriptores)",
+        "frecuencia": int(resto["frecuencia"].sum()),
+        "porcentaje": round(float(resto["porcentaje"].sum()), 2),
+        "acumulado": int(resto["acumulado"].iloc[-1]),
+        "pct_acum": float(resto["pct_acum"].iloc[-1]),
+        "segmento_real": "80%" if (resto["segmento_real"] == "80%").all() else "20%",
+        "segmento": "80%",
+    }])
+    return pd.concat([cabeza, otros[cabeza.columns.intersection(otros.columns)]], ignore_index=True)
+
+
+def _pareto_pngs(df_par: pd.DataFrame, titulo: str) -> List[bytes]:
+    """
+    PNG(s) del Pareto para PDF con el ancho acotado a PARETO_ANCHO_MAX_PX.
+    Si el Pareto completo cabe, una sola imagen; si no, top-N + «Otros» o tramos
+    consecutivos (cada tramo conserva el % acumulado global).
+    """
+    if _pareto_ancho_pulg(len(df_par)) * PARETO_PDF_DPI <= PARETO_ANCHO_MAX_PX:
+        return [_pareto_png(df_par, titulo)]
+    if PARETO_MODO_ANCHO == "paginas":
+        tramos = [df_par.iloc[i:i + PARETO_POR_PAGINA] for i in range(0, len(df_par), PARETO_POR_PAGINA)]
+        return [_pareto_png(t, f"{titulo} ({k}/{len(tramos)})") for k, t in enumerate(tramos, 1)]
+    return [_pareto_png(_pareto_con_otros(df_par, PARETO_TOP_N), titulo)]
+
+
 def _pareto_png(df_par: pd.DataFrame, titulo: str) -> bytes:
+    """PNG del Pareto para PDF (desde la caché de gráficos si ya se generó)."""
+    return _grafico_cacheado(_firma_pareto(df_par, titulo, "pdf", PARETO_PDF_DPI, PARETO_ANCHO_MAX_PX),
+                             lambda: _pareto_png_render(df_par, titulo))
+
+
+def _pareto_png_render(df_par: pd.DataFrame, titulo: str) -> bytes:
     """
     PNG del Pareto para PDF:
     - Etiquetas 90° a 2 líneas
@@ -680,49 +2458,33 @@ def _pareto_png(df_par: pd.DataFrame, titulo: str) -> bytes:
     pct_acum = df_par["pct_acum"].to_numpy()
     colors_b = _colors_for_segments(df_par["segmento_real"].tolist())
 
-    fig_w = max(12.0, 0.60 * n_labels)
+    fig_w = _pareto_ancho_pulg(n_labels)
     fig_h = 6.6
     fs    = 9 if n_labels > 28 else 10
-    dpi   = 220
+    dpi   = min(PARETO_PDF_DPI, PARETO_ANCHO_MAX_PX / fig_w)  # último resguardo del tope de píxeles
 
-    fig, ax1 = plt.subplots(figsize=(fig_w, fig_h), dpi=dpi)
-    ax1.bar(x, freqs, color=colors_b, zorder=2)
-    ax1.set_ylabel("Frecuencia")
-    ax1.set_xticks(x)
-    ax1.set_xticklabels(labels_w, rotation=90, ha="center", va="top", fontsize=fs)
-    ax1.set_title(titulo if titulo.strip() else "Diagrama de Pareto", color=TEXTO, fontsize=16)
+    def _dibujar(fig, ax1):
+        ax1.bar(x, freqs, color=colors_b, zorder=2)
+        ax1.set_ylabel("Frecuencia")
+        ax1.set_xticks(x)
+        ax1.set_xticklabels(labels_w, rotation=90, ha="center", va="top", fontsize=fs)
+        ax1.set_title(titulo if titulo.strip() else "Diagrama de Pareto", color=TEXTO, fontsize=16)
 
-    ax2 = ax1.twinx()
-    ax2.plot(x, pct_acum, marker="o", linewidth=2, color=TEXTO, zorder=3)
-    ax2.set_ylabel("% acumulado"); ax2.set_ylim(0, 110)
+        ax2 = _estilar_ejes(ax1.twinx())
+        ax2.plot(x, pct_acum, marker="o", linewidth=2, color=TEXTO, zorder=3)
+        ax2.set_ylabel("% acumulado"); ax2.set_ylim(0, 110)
 
-    if (df_par["segmento_real"] == "80%").any():
-        cut_idx = np.where(df_par["segmento_real"].to_numpy() == "80%")[0].max()
-        ax1.axvline(cut_idx + 0.5, linestyle=":", color="k")
-    ax2.axhline(80, linestyle="--", linewidth=1, color="#666666")
-    ax1.grid(True, axis="y", alpha=0.25, zorder=1)
+        if (df_par["segmento_real"] == "80%").any():
+            cut_idx = np.where(df_par["segmento_real"].to_numpy() == "80%")[0].max()
+            ax1.axvline(cut_idx + 0.5, linestyle=":", color="k")
+        ax2.axhline(80, linestyle="--", linewidth=1, color="#666666")
+        ax1.grid(True, axis="y", alpha=0.25, zorder=1)
 
-    buf = io.BytesIO()
-    fig.savefig(buf, format="PNG", dpi=dpi, bbox_inches="tight", pad_inches=0.08)
-    plt.close(fig)
-    return buf.getvalue()
+    return _render_png(_dibujar, figsize=(fig_w, fig_h), dpi=dpi,
+                       bbox_inches="tight", pad_inches=0.08)
 
 
 
-# --- Etiquetado temático (se mantiene interno) ---
-def _tema_descriptor(descriptor: str) -> str:
-    d = descriptor.lower()
-    if "droga" in d or "búnker" in d or "bunker" in d or "narco" in d or "venta de drogas" in d:
-        return "drogas"
-    if "robo" in d or "hurto" in d or "asalto" in d or "vehícul" in d or "comercio" in d:
-        return "delitos contra la propiedad"
-    if "violencia" in d or "lesion" in d or "homicidio" in d:
-        return "violencia"
-    if "infraestructura" in d or "alumbrado" in d or "lotes" in d:
-        return "condiciones urbanas / entorno"
-    return "seguridad y convivencia"
-
-
 def _resumen_texto(df_par: pd.DataFrame) -> str:
     if df_par.empty:
         return "Sin datos disponibles."
@@ -748,6 +2510,15 @@ def _texto_modalidades(descriptor: str, pares: List[Tuple[str, float]]) -> str:
 
 
 def _modalidades_png(title: str, data_pairs: List[Tuple[str, float]], kind: str = "barh") -> bytes:
+    clave = hashlib.sha1(repr((title, [(str(l), float(p or 0)) for l, p in data_pairs],
+                               kind, "modalidades", MODALIDADES_DPI)).encode("utf-8")).hexdigest()
+    return _grafico_cacheado(clave, lambda: _modalidades_png_render(title, data_pairs, kind))
+
+
+def _modalidades_png_render(title: str, data_pairs: List[Tuple[str, float]], kind: str = "barh") -> bytes:
+    import matplotlib as mpl
+    from matplotlib.patches import FancyBboxPatch, Circle
+
     labels = [l for l, p in data_pairs if str(l).strip()]
     vals   = [float(p or 0) for l, p in data_pairs if str(l).strip()]
     if not labels:
@@ -758,120 +2529,118 @@ def _modalidades_png(title: str, data_pairs: List[Tuple[str, float]], kind: str
     vals   = [vals[i]   for i in order]
     n = len(labels)
 
-    import matplotlib as mpl
-    from matplotlib.patches import FancyBboxPatch, Circle
-
-    cmap = mpl.cm.get_cmap("Blues")
+    cmap = mpl.colormaps["Blues"]
     colors_seq = [cmap(0.35 + 0.5*(i/max(1, n-1))) for i in range(n)]
 
     if kind == "donut":
-        fig, ax = plt.subplots(figsize=(7.8, 5.4))
-        wedges, _, _ = ax.pie(
-            vals, labels=None, autopct=lambda p: f"{p:.1f}%",
-            startangle=90, pctdistance=0.8,
-            wedgeprops=dict(width=0.4, edgecolor="white"),
-            colors=colors_seq
-        )
-        ax.legend(wedges, [f"{l} ({v:.1f}%)" for l, v in zip(labels, vals)],
-                  title="Modalidades", loc="center left",
-                  bbox_to_anchor=(1.02, 0.5), fontsize=9)
-        ax.set_title(title, color=TEXTO)
-
-    elif kind == "lollipop":
-        fig, ax = plt.subplots(figsize=(11.5, 5.4))
-        y = np.arange(n)
-        ax.hlines(y=y, xmin=0, xmax=vals, color="#94a3b8", linewidth=2)
-        ax.plot(vals, y, "o", markersize=8, color=AZUL)
-        ax.set_yticks(y)
-        ax.set_yticklabels(_wrap_labels(labels, 35))
-        ax.invert_yaxis()
-        ax.set_xlabel("Porcentaje"); ax.set_xlim(0, max(100, max(vals)*1.05))
-        for i, v in enumerate(vals):
-            ax.text(v + 1, i, f"{v:.1f}%", va="center", fontsize=10)
-        ax.set_title(title, color=TEXTO)
-
-    elif kind == "bar":
-        fig, ax = plt.subplots(figsize=(11.5, 5.4))
-        x = np.arange(n)
-        ax.bar(x, vals, color=colors_seq)
-        ax.set_xticks(x)
-        ax.set_xticklabels(_wrap_labels(labels, 20), rotation=0)
-        ax.set_ylabel("Porcentaje"); ax.set_ylim(0, max(100, max(vals)*1.15))
-        for i, v in enumerate(vals):
-            ax.text(i, v + max(vals)*0.03, f"{v:.1f}%", ha="center", fontsize=10)
-        ax.set_title(title, color=TEXTO)
-
+        figsize = (7.8, 5.4)
     elif kind == "comp100":
-        fig, ax = plt.subplots(figsize=(11.5, 3.0))
-        left = 0.0
-        for i, (lab, v) in enumerate(zip(labels, vals)):
-            w = max(0.0, float(v))
-            ax.barh(0, w, left=left, color=colors_seq[i])
-            if w >= 7:
-                ax.text(left + w/2, 0, f"{lab}\n{v:.1f}%", va="center", ha="center", fontsize=9, color="white")
-            left += w
-        ax.set_xlim(0, max(100, sum(vals)))
-        ax.set_yticks([]); ax.set_xlabel("Porcentaje (composición)")
-        ax.set_title(title, color=TEXTO)
-        ax.grid(False)
-
+        figsize = (11.5, 3.0)
     elif kind == "pill":
-        fig_height = 0.9 + n*0.85
-        fig, ax = plt.subplots(figsize=(10.8, fig_height))
-        ax.set_xlim(0, 100); ax.set_ylim(0, n)
-        ax.axis("off")
-        track_h = 0.72
-        round_r = track_h/2
-
-        for i, (lab, v) in enumerate(zip(labels, vals)):
-            y = n - 1 - i + (1 - track_h)/2
-            track = FancyBboxPatch(
-                (0.8, y), 98.4, track_h,
-                boxstyle=f"round,pad=0,rounding_size={round_r}",
-                linewidth=1, edgecolor="#9dbbd6", facecolor="#e6f0fb"
-            )
-            ax.add_patch(track)
-
-            prog_w = max(0.001, min(98.4, float(v)))
-            prog = FancyBboxPatch(
-                (0.8, y), prog_w, track_h,
-                boxstyle=f"round,pad=0,rounding_size={round_r}",
-                linewidth=0, facecolor=AZUL, alpha=0.35
-            )
-            ax.add_patch(prog)
-
-            ax.add_patch(Circle((0.8 + round_r*0.6, y + track_h/2), round_r*0.9, color=AZUL, alpha=0.9))
-            badge_w = 12.0; badge_h = track_h*0.8
-            badge_x = 5.0;  badge_y = y + (track_h - badge_h)/2
-            badge = FancyBboxPatch(
-                (badge_x, badge_y), badge_w, badge_h,
-                boxstyle=f"round,pad=0.25,rounding_size={badge_h/2}",
-                linewidth=1, edgecolor="#cfd8e3", facecolor="white"
+        figsize = (10.8, 0.9 + n*0.85)
+    else:
+        figsize = (11.5, 5.4)
+
+    def _dibujar(fig, ax):
+        if kind == "donut":
+            wedges, _, _ = ax.pie(
+                vals, labels=None, autopct=lambda p: f"{p:.1f}%",
+                startangle=90, pctdistance=0.8,
+                wedgeprops=dict(width=0.4, edgecolor="white"),
+                colors=colors_seq
             )
-            ax.add_patch(badge)
-            ax.text(badge_x + badge_w/2, y + track_h/2, f"{v:.1f}%", ha="center", va="center", fontsize=10)
-            ax.text(badge_x + badge_w + 3.0, y + track_h/2, lab, va="center", ha="left",
-                    fontsize=12, color="#0f172a")
-
-        ax.set_title(title, color=TEXTO)
-
-    else:  # 'barh'
-        fig, ax = plt.subplots(figsize=(11.5, 5.4))
-        y = np.arange(n)
-        ax.barh(y, vals, color=colors_seq)
-        ax.set_yticks(y)
-        ax.set_yticklabels(_wrap_labels(labels, 35))
-        ax.invert_yaxis()
-        ax.set_xlabel("Porcentaje")
-        ax.set_xlim(0, max(100, max(vals)*1.05))
-        for i, v in enumerate(vals):
-            ax.text(v + 1, i, f"{v:.1f}%", va="center", fontsize=10)
-        ax.set_title(title, color=TEXTO)
-
-    buf = io.BytesIO()
-    fig.savefig(buf, format="PNG", dpi=dpi, bbox_inches="tight", pad_inches=0.08)
-    plt.close(fig)
-    return buf.getvalue()
+            ax.legend(wedges, [f"{l} ({v:.1f}%)" for l, v in zip(labels, vals)],
+                      title="Modalidades", loc="center left",
+                      bbox_to_anchor=(1.02, 0.5), fontsize=9)
+            ax.set_title(title, color=TEXTO, fontsize=ESTILO_GRAFICOS["titulo"])
+
+        elif kind == "lollipop":
+            y = np.arange(n)
+            ax.hlines(y=y, xmin=0, xmax=vals, color="#94a3b8", linewidth=2)
+            ax.plot(vals, y, "o", markersize=8, color=AZUL)
+            ax.set_yticks(y)
+            ax.set_yticklabels(_wrap_labels(labels, 35))
+            ax.invert_yaxis()
+            ax.set_xlabel("Porcentaje"); ax.set_xlim(0, max(100, max(vals)*1.05))
+            for i, v in enumerate(vals):
+                ax.text(v + 1, i, f"{v:.1f}%", va="center", fontsize=10)
+            ax.set_title(title, color=TEXTO, fontsize=ESTILO_GRAFICOS["titulo"])
+
+        elif kind == "bar":
+            x = np.arange(n)
+            ax.bar(x, vals, color=colors_seq)
+            ax.set_xticks(x)
+            ax.set_xticklabels(_wrap_labels(labels, 20), rotation=0)
+            ax.set_ylabel("Porcentaje"); ax.set_ylim(0, max(100, max(vals)*1.15))
+            for i, v in enumerate(vals):
+                ax.text(i, v + max(vals)*0.03, f"{v:.1f}%", ha="center", fontsize=10)
+            ax.set_title(title, color=TEXTO, fontsize=ESTILO_GRAFICOS["titulo"])
+
+        elif kind == "comp100":
+            left = 0.0
+            for i, (lab, v) in enumerate(zip(labels, vals)):
+                w = max(0.0, float(v))
+                ax.barh(0, w, left=left, color=colors_seq[i])
+                if w >= 7:
+                    ax.text(left + w/2, 0, f"{lab}\n{v:.1f}%", va="center", ha="center", fontsize=9, color="white")
+                left += w
+            ax.set_xlim(0, max(100, sum(vals)))
+            ax.set_yticks([]); ax.set_xlabel("Porcentaje (composición)")
+            ax.set_title(title, color=TEXTO, fontsize=ESTILO_GRAFICOS["titulo"])
+            ax.grid(False)
+
+        elif kind == "pill":
+            ax.set_xlim(0, 100); ax.set_ylim(0, n)
+            ax.axis("off")
+            track_h = 0.72
+            round_r = track_h/2
+
+            for i, (lab, v) in enumerate(zip(labels, vals)):
+                y = n - 1 - i + (1 - track_h)/2
+                track = FancyBboxPatch(
+                    (0.8, y), 98.4, track_h,
+                    boxstyle=f"round,pad=0,rounding_size={round_r}",
+                    linewidth=1, edgecolor="#9dbbd6", facecolor="#e6f0fb"
+                )
+                ax.add_patch(track)
+
+                prog_w = max(0.001, min(98.4, float(v)))
+                prog = FancyBboxPatch(
+                    (0.8, y), prog_w, track_h,
+                    boxstyle=f"round,pad=0,rounding_size={round_r}",
+                    linewidth=0, facecolor=AZUL, alpha=0.35
+                )
+                ax.add_patch(prog)
+
+                ax.add_patch(Circle((0.8 + round_r*0.6, y + track_h/2), round_r*0.9, color=AZUL, alpha=0.9))
+                badge_w = 12.0; badge_h = track_h*0.8
+                badge_x = 5.0;  badge_y = y + (track_h - badge_h)/2
+                badge = FancyBboxPatch(
+                    (badge_x, badge_y), badge_w, badge_h,
+                    boxstyle=f"round,pad=0.25,rounding_size={badge_h/2}",
+                    linewidth=1, edgecolor="#cfd8e3", facecolor="white"
+                )
+                ax.add_patch(badge)
+                ax.text(badge_x + badge_w/2, y + track_h/2, f"{v:.1f}%", ha="center", va="center", fontsize=10)
+                ax.text(badge_x + badge_w + 3.0, y + track_h/2, lab, va="center", ha="left",
+                        fontsize=12, color="#0f172a")
+
+            ax.set_title(title, color=TEXTO, fontsize=ESTILO_GRAFICOS["titulo"])
+
+        else:  # 'barh'
+            y = np.arange(n)
+            ax.barh(y, vals, color=colors_seq)
+            ax.set_yticks(y)
+            ax.set_yticklabels(_wrap_labels(labels, 35))
+            ax.invert_yaxis()
+            ax.set_xlabel("Porcentaje")
+            ax.set_xlim(0, max(100, max(vals)*1.05))
+            for i, v in enumerate(vals):
+                ax.text(v + 1, i, f"{v:.1f}%", va="center", fontsize=10)
+            ax.set_title(title, color=TEXTO, fontsize=ESTILO_GRAFICOS["titulo"])
+
+    return _render_png(_dibujar, figsize=figsize, dpi=MODALIDADES_DPI,
+                       bbox_inches="tight", pad_inches=0.08)
 
 
 
@@ -880,16 +2649,19 @@ def _modalidades_png(title: str, data_pairs: List[Tuple[str, float]], kind: str
 # ========= Tabla PDF, generador de Informe PDF y UI de desgloses ===========
 # ============================================================================
 
-def _tabla_resultados_flowable(df_par: pd.DataFrame, doc_width: float) -> Table:
+def _tabla_resultados_flowable(df_par: pd.DataFrame, doc_width: float,
+                               encabezado: str = "Descriptor") -> "Table":
     """
-    Cuadro simplificado: Descriptor | Frecuencia | %
+    Cuadro simplificado: Descriptor (o el nivel agregado) | Frecuencia | %
     Incluye una fila final con 'Total de respuestas tratadas'.
     """
     fracs = [0.62, 0.20, 0.18]  # Descriptor, Frecuencia, %
     col_widths = [f * doc_width for f in fracs]
     stys = _styles()
 
+    from reportlab.lib import colors
     from reportlab.lib.styles import ParagraphStyle
+    from reportlab.platypus import Paragraph, Table, TableStyle
     cell_style = ParagraphStyle(
         name="CellWrap",
         parent=stys["Normal"],
@@ -902,7 +2674,7 @@ def _tabla_resultados_flowable(df_par: pd.DataFrame, doc_width: float) -> Table:
     )
 
     head = [
-        Paragraph("Descriptor", stys["TableHead"]),
+        Paragraph(encabezado, stys["TableHead"]),
         Paragraph("Frecuencia", stys["TableHead"]),
         Paragraph("Porcentaje", stys["TableHead"]),
     ]
@@ -952,18 +2724,40 @@ def _altura_img_según_filas(n_filas: int) -> float:
     return 8.6
 
 
+def _rl_imagen_ancho(png: bytes, ancho: float) -> "RLImage":
+    """Imagen a 'ancho' puntos con la altura proporcional al PNG."""
+    from PIL import Image as PILImage
+    from reportlab.platypus import Image as RLImage
+    with io.BytesIO(png) as _b:
+        w_px, h_px = PILImage.open(_b).size
+    return RLImage(io.BytesIO(png), width=ancho, height=(h_px / w_px) * ancho)
+
+
 def generar_pdf_informe(nombre_informe: str,
                         df_par: pd.DataFrame,
-                        desgloses: List[Dict]) -> bytes:
+                        desgloses: List[Dict],
+                        agregados: Tuple[str, ...] = (),
+                        fecha: Optional[str] = None) -> bytes:
     """
     Genera el informe PDF completo: portada, introducción, gráfico, tabla,
-    modalidades y conclusiones. Inserta el gráfico de Pareto a ancho completo,
+    Paretos por categoría/tema (si se piden en 'agregados'), modalidades y
+    conclusiones. Inserta el gráfico de Pareto a ancho completo,
     calculando la altura proporcional al PNG generado (misma apariencia que en la app).
+    'fecha' (dd/mm/aaaa) es la de la portada; por defecto, hoy.
     """
     if df_par.empty:
         st.warning("No hay datos válidos para generar el informe.")
         return b""
 
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import cm
+    from reportlab.platypus import (
+        BaseDocTemplate, PageTemplate, Frame,
+        Paragraph, Spacer, Image as RLImage,
+        PageBreak, NextPageTemplate
+    )
+    from reportlab.platypus.flowables import KeepTogether
+
     buf = io.BytesIO()
     doc = BaseDocTemplate(
         buf, pagesize=A4,
@@ -985,7 +2779,7 @@ def generar_pdf_informe(nombre_informe: str,
     story += [Spacer(1, 2.2*cm)]
     story += [Paragraph(f"Informe de Resultados Diagrama de Pareto - {nombre_informe}", stys["CoverTitle"])]
     story += [Paragraph("Estrategia Sembremos Seguridad", stys["CoverSubtitle"])]
-    story += [Paragraph(datetime.now().strftime("Fecha: %d/%m/%Y"), stys["CoverDate"])]
+    story += [Paragraph(f"Fecha: {fecha or datetime.now().strftime('%d/%m/%Y')}", stys["CoverDate"])]
     story += [PageBreak()]
 
     # ---------- INTRODUCCIÓN ----------
@@ -1003,25 +2797,29 @@ def generar_pdf_informe(nombre_informe: str,
     story += [Paragraph(_resumen_texto(df_par), stys["Body"]), Spacer(1, 0.3*cm)]
 
     # --- Gráfico Pareto a ancho completo con altura proporcional ---
-    from PIL import Image as PILImage
-    pareto_png = _pareto_png(df_par, "Diagrama de Pareto")
-    with io.BytesIO(pareto_png) as _b:
-        im = PILImage.open(_b)
-        w_px, h_px = im.size
+    pareto_pngs = _pareto_pngs(df_par, "Diagrama de Pareto")
+    imagenes = [_rl_imagen_ancho(png, doc.width) for png in pareto_pngs]
 
-    width_pts  = doc.width
-    height_pts = (h_px / w_px) * width_pts
+    nota = ""
+    if len(pareto_pngs) > 1:
+        nota = f" El gráfico se divide en {len(pareto_pngs)} tramos consecutivos; el % acumulado es el del total."
+    elif len(df_par) > PARETO_TOP_N and PARETO_MODO_ANCHO == "otros" \
+            and _pareto_ancho_pulg(len(df_par)) * PARETO_PDF_DPI > PARETO_ANCHO_MAX_PX:
+        nota = (f" Se grafican los {PARETO_TOP_N} descriptores principales y el resto se agrupa en «Otros»; "
+                "la tabla lista todos los descriptores.")
 
     # 1) Gráfico + descripción siempre juntos
     story.append(KeepTogether([
-        RLImage(io.BytesIO(pareto_png), width=width_pts, height=height_pts),
+        imagenes[0],
         Spacer(1, 0.30*cm),
         Paragraph(
             "El diagrama muestra la frecuencia por descriptor (barras en verde/azul) y el <b>porcentaje acumulado</b> (línea). "
-            "La línea punteada del 80% indica el <b>punto de corte</b> para priorización.",
+            "La línea punteada del 80% indica el <b>punto de corte</b> para priorización." + nota,
             stys["Small"]
         ),
     ]))
+    for img in imagenes[1:]:
+        story += [Spacer(1, 0.30*cm), img]
 
     # 2) Salto de página si el gráfico es largo
     if len(df_par) >= 12:
@@ -1033,6 +2831,29 @@ def generar_pdf_informe(nombre_informe: str,
         _tabla_resultados_flowable(df_par, doc.width),
     ]))
 
+    # ---------- PARETOS POR CATEGORÍA / TEMA (opcionales) ----------
+    for nivel in agregados:
+        etiqueta = NIVELES_AGREGADO[nivel]
+        df_n = pareto_agregado(df_par, nivel)
+        top = df_n.iloc[0]
+        story.append(KeepTogether([
+            Spacer(1, 0.4*cm),
+            Paragraph(f"Pareto por {etiqueta.lower()}", stys["TitleBig"]),
+            Spacer(1, 0.1*cm),
+            Paragraph(
+                f"Los descriptores se agrupan en <b>{len(df_n)}</b> grupos por {etiqueta.lower()}. "
+                f"El de mayor peso es <b>{top['descriptor']}</b>, con <b>{int(top['frecuencia'])}</b> casos "
+                f"({float(top['porcentaje']):.2f}%).",
+                stys["Small"]
+            ),
+            Spacer(1, 0.2*cm),
+            _rl_imagen_ancho(_pareto_png(df_n, f"Pareto por {etiqueta.lower()}"), doc.width),
+        ]))
+        story.append(KeepTogether([
+            Spacer(1, 0.25*cm),
+            _tabla_resultados_flowable(df_n, doc.width, encabezado=etiqueta),
+        ]))
+
 
     # ---------- MODALIDADES ----------
     for sec in desgloses:
@@ -1078,6 +2899,33 @@ def generar_pdf_informe(nombre_informe: str,
     return buf.getvalue()
 
 
+@st.cache_data(show_spinner=False, max_entries=32)
+def _pdf_memo_fecha(nombre_informe: str, df_par: pd.DataFrame, desgloses: List[Dict],
+                    agregados: Tuple[str, ...], fecha: str) -> bytes:
+    return generar_pdf_informe(nombre_informe, df_par, desgloses, agregados, fecha=fecha)
+
+
+def _pdf_memo(nombre_informe: str, df_par: pd.DataFrame, desgloses: List[Dict],
+              agregados: Tuple[str, ...] = ()) -> bytes:
+    """
+    Mismo informe (nombre, Pareto, desgloses, secciones) y mismo día -> mismos bytes,
+    sin regenerar. La fecha de la portada es parte de la llave: al cambiar el día no
+    se sirve un PDF con la fecha anterior.
+    """
+    fecha = datetime.now().strftime("%d/%m/%Y")
+    return _pdf_memo_fecha(nombre_informe, df_par, desgloses, agregados, fecha)
+
+
+def ui_secciones_agregadas(key_prefix: str) -> Tuple[str, ...]:
+    """Secciones opcionales del PDF con el Pareto por categoría y/o por tema."""
+    return tuple(st.multiselect(
+        "Secciones adicionales del informe",
+        options=list(NIVELES_AGREGADO),
+        format_func=lambda n: f"Pareto por {NIVELES_AGREGADO[n].lower()}",
+        key=f"{key_prefix}_agregados",
+    ))
+
+
 # === UI formulario de desgloses (para editor y unificado) ===
 def ui_desgloses(descriptor_list: List[str], key_prefix: str) -> List[Dict]:
     st.caption("Opcional: agrega secciones de ‘Modalidades’. Cada sección admite hasta 10 filas (Etiqueta + %).")
@@ -1128,6 +2976,33 @@ def ui_desgloses(descriptor_list: List[str], key_prefix: str) -> List[Dict]:
 # ============================================================================
 
 st.title("📊 Análisis Pareto 80/20 – Descriptores y Portafolio")
+ui_estado_sincronizacion()
+if st.session_state["portafolio_error"]:
+    st.error(st.session_state["portafolio_error"])
+    if st.button("🔄 Reintentar carga del portafolio", key="reload_port"):
+        st.session_state["portafolio_error"] = None
+        st.rerun()
+
+# Cada pestaña es un fragmento: interactuar con un widget vuelve a ejecutar solo
+# su sección (st.fragment, Streamlit ≥ 1.37). En versiones previas se ejecuta todo.
+_fragmento = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda f: f)
+
+
+def _cronometrado(seccion: str):
+    """Mide la ejecución de una sección y la muestra al pie de la misma."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def envoltura(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                ms = (time.perf_counter() - t0) * 1000
+                st.session_state.setdefault("tiempos_render", {})[seccion] = ms
+                st.caption(f"⏱️ Sección «{seccion}» ejecutada en {ms:.0f} ms")
+        return envoltura
+    return deco
+
 
 tab_editor, tab_portafolio, tab_unificado = st.tabs([
     "➕ Crear / Editar Pareto individual",
@@ -1138,13 +3013,15 @@ tab_editor, tab_portafolio, tab_unificado = st.tabs([
 # ---------------------------------------------------------------------------
 # TAB 1 — Editor individual
 # ---------------------------------------------------------------------------
-with tab_editor:
+@_fragmento
+@_cronometrado("editor")
+def _seccion_editor():
     st.subheader("✏️ Editor de Pareto individual")
 
     nombre_pareto = st.text_input("Nombre del Pareto", "").strip()
 
     # Selector múltiple (CATÁLOGO EMBEBIDO) — ahora con key fijo
-    opts = [c["descriptor"] for c in CATALOGO]
+    opts = list(INDICE.descriptores)
     msel = st.multiselect(
         "Selecciona los descriptores a incluir",
         options=opts,
@@ -1180,7 +3057,7 @@ with tab_editor:
 
         # Actualizar el DF y el freq_map en sesión con lo que el usuario acaba de escribir
         st.session_state["editor_df"] = df_edit
-        freq_map = dict(zip(df_edit["descriptor"], df_edit["frecuencia"]))
+        freq_map = MapaFrecuencias.desde(dict(zip(df_edit["descriptor"], df_edit["frecuencia"])))
         st.session_state["freq_map"] = freq_map
 
         # Cálculo y vista previa del Pareto
@@ -1188,22 +3065,20 @@ with tab_editor:
         st.divider()
         st.subheader("📊 Diagrama de Pareto (Vista previa)")
         dibujar_pareto(df_par, nombre_pareto)
-        st.download_button(
-            "📥 Exportar Excel con gráfico",
-            exportar_excel_con_grafico(df_par, nombre_pareto),
-            file_name=f"Pareto_{nombre_pareto or 'sin_nombre'}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+        ui_paretos_agregados(df_par, nombre_pareto or "Pareto", key="editor")
+        ui_descarga_excel(df_par, nombre_pareto,
+                          file_name=f"Pareto_{nombre_pareto or 'sin_nombre'}.xlsx", key="editor")
 
         st.divider()
         desgloses = ui_desgloses(df_par["descriptor"].tolist(), key_prefix="editor")
+        agregados = ui_secciones_agregadas("editor")
 
         col1, col2 = st.columns(2)
         with col1:
             if st.button("💾 Guardar en Portafolio (y Sheets)", type="primary", use_container_width=True):
                 if nombre_pareto:
                     st.session_state["portafolio"][nombre_pareto] = normalizar_freq_map(freq_map)
-                    sheets_guardar_pareto(nombre_pareto, freq_map, sobrescribir=True)
+                    sheets_guardar_pareto_diferido(nombre_pareto, freq_map)
                     st.success(f"Pareto '{nombre_pareto}' guardado correctamente.")
                     st.session_state["reset_after_save"] = True
                     st.rerun()  # ✅ mantiene el comportamiento
@@ -1214,7 +3089,7 @@ with tab_editor:
                 if not nombre_pareto:
                     st.warning("Asigna un nombre para el informe.")
                 else:
-                    pdf_bytes = generar_pdf_informe(nombre_pareto, df_par, desgloses)
+                    pdf_bytes = _pdf_memo(nombre_pareto, df_par, desgloses, agregados)
                     if pdf_bytes:
                         st.download_button(
                             label="📥 Descargar PDF",
@@ -1233,38 +3108,64 @@ with tab_editor:
 # ---------------------------------------------------------------------------
 # TAB 2 — Portafolio de Paretos
 # ---------------------------------------------------------------------------
-with tab_portafolio:
+@_fragmento
+@_cronometrado("portafolio")
+def _seccion_portafolio():
     st.subheader("📁 Paretos almacenados en portafolio")
 
     port = st.session_state["portafolio"]
     if not port:
         st.info("No hay Paretos guardados todavía.")
     else:
-        for nombre, mapa in list(port.items()):
-            with st.expander(f"{nombre}", expanded=False):
-                dfp = calcular_pareto(df_desde_freq_map(mapa))
+        # Búsqueda + paginación: solo se dibujan/exportan los Paretos que el usuario abre
+        colF, colN = st.columns([3, 1])
+        with colF:
+            filtro = st.text_input("🔎 Buscar Pareto por nombre", key="port_buscar").strip().lower()
+        with colN:
+            por_pagina = st.selectbox("Paretos por página", options=[10, 25, 50], key="port_por_pagina")
+        nombres_f = [n for n in port if filtro in n.lower()]
+        n_paginas = max(1, -(-len(nombres_f) // por_pagina))
+        # El valor del widget vive solo en session_state (sin value=, que choca con la key)
+        st.session_state.setdefault("port_pagina", 1)
+        if st.session_state["port_pagina"] > n_paginas:
+            st.session_state["port_pagina"] = n_paginas
+        pagina = st.number_input(f"Página (de {n_paginas})", min_value=1, max_value=n_paginas,
+                                 step=1, key="port_pagina")
+        st.caption(f"{len(nombres_f)} de {len(port)} Paretos coinciden con la búsqueda.")
+
+        inicio = (int(pagina) - 1) * por_pagina
+        visibles = nombres_f[inicio:inicio + por_pagina]
+        # Los Paretos abiertos de la página se calculan juntos en una sola pasada
+        abiertos = [n for n in visibles if st.session_state.get(f"open_{n}")]
+        paretos = separar_paretos(calcular_paretos_lote(port.largo(abiertos))) if abiertos else {}
+        for nombre in visibles:
+            resumen = port.resumen(nombre)
+            with st.expander(f"{nombre} — {resumen['descriptores']} descriptores · "
+                             f"{resumen['total']} respuestas", expanded=False):
+                colT, colB = st.columns([3, 1])
+                with colT:
+                    abierto = st.toggle("Mostrar gráfico, Excel e informe PDF", key=f"open_{nombre}")
+                with colB:
+                    if st.button(f"🗑️ Eliminar '{nombre}'", key=f"del_{nombre}"):
+                        del st.session_state["portafolio"][nombre]
+                        sheets_eliminar_pareto_diferido(nombre)
+                        st.success(f"El Pareto '{nombre}' fue eliminado; Google Sheets se actualiza en segundo plano.")
+                        st.rerun()  # ✅ reemplazo de experimental_rerun
+                if not abierto:
+                    continue
+
+                dfp = paretos.get(nombre)
+                if dfp is None:
+                    dfp = calcular_pareto(df_desde_freq_map(port[nombre]))
                 dibujar_pareto(dfp, nombre)
+                ui_paretos_agregados(dfp, nombre, key=f"port_{nombre}")
                 st.caption(f"Total de respuestas tratadas: {int(dfp['frecuencia'].sum())}")
 
                 # Acciones
-                colA, colB, colC = st.columns([1,1,2])
+                colA, colC = st.columns([1, 2])
                 with colA:
-                    st.download_button(
-                        "📥 Excel con gráfico",
-                        exportar_excel_con_grafico(dfp, nombre),
-                        file_name=f"Pareto_{nombre}.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        key=f"dl_{nombre}"
-                    )
-                with colB:
-                    if st.button(f"🗑️ Eliminar '{nombre}'", key=f"del_{nombre}"):
-                        del st.session_state["portafolio"][nombre]
-                        ok = sheets_eliminar_pareto(nombre)
-                        if ok:
-                            st.success(f"El Pareto '{nombre}' fue eliminado del sistema y de Google Sheets.")
-                        else:
-                            st.warning(f"El Pareto '{nombre}' se eliminó localmente, pero no pudo borrarse en Sheets.")
-                        st.rerun()  # ✅ reemplazo de experimental_rerun
+                    ui_descarga_excel(dfp, nombre, file_name=f"Pareto_{nombre}.xlsx",
+                                      key=f"port_{nombre}", etiqueta="📥 Excel con gráfico")
                 with colC:
                     try:
                         pop = st.popover("📄 Informe PDF de este Pareto")
@@ -1273,8 +3174,9 @@ with tab_portafolio:
                     with pop:
                         nombre_inf_ind = st.text_input("Nombre del informe", value=f"{nombre}", key=f"inf_nom_{nombre}")
                         desgloses_ind = ui_desgloses(dfp["descriptor"].tolist(), key_prefix=f"inf_{nombre}")
+                        agregados_ind = ui_secciones_agregadas(f"inf_{nombre}")
                         if st.button("Generar PDF", key=f"btn_inf_{nombre}"):
-                            pdf_bytes = generar_pdf_informe(nombre_inf_ind, dfp, desgloses_ind)
+                            pdf_bytes = _pdf_memo(nombre_inf_ind, dfp, desgloses_ind, agregados_ind)
                             if pdf_bytes:
                                 st.download_button(
                                     "⬇️ Descargar PDF",
@@ -1287,7 +3189,9 @@ with tab_portafolio:
 # ---------------------------------------------------------------------------
 # TAB 3 — Informe unificado
 # ---------------------------------------------------------------------------
-with tab_unificado:
+@_fragmento
+@_cronometrado("unificado")
+def _seccion_unificado():
     st.subheader("📄 Informe PDF (unificado)")
 
     port = st.session_state["portafolio"]
@@ -1302,17 +3206,24 @@ with tab_unificado:
         )
 
         if seleccion:
-            mapas = [port[n] for n in seleccion]
-            mapa_total = combinar_maps(mapas)
-            df_uni = calcular_pareto(df_desde_freq_map(mapa_total))
+            mapa_total = port.unificado(seleccion)
+            # mismo objeto => misma selección y portafolio sin cambios: se reutiliza el Pareto
+            memo = st.session_state.get("_uni_pareto")
+            if memo is not None and memo[0] is mapa_total:
+                df_uni = memo[1]
+            else:
+                df_uni = calcular_pareto(df_desde_freq_map(mapa_total))
+                st.session_state["_uni_pareto"] = (mapa_total, df_uni)
             st.subheader("📊 Vista previa Pareto Unificado")
             dibujar_pareto(df_uni, "Pareto Unificado")
+            ui_paretos_agregados(df_uni, "Pareto Unificado", key="uni")
             st.caption(f"Total de respuestas tratadas: {int(df_uni['frecuencia'].sum())}")
 
             desgloses_uni = ui_desgloses(df_uni["descriptor"].tolist(), key_prefix="uni")
+            agregados_uni = ui_secciones_agregadas("uni")
 
             if st.button("📄 Generar Informe PDF (Unificado)", type="primary"):
-                pdf_bytes = generar_pdf_informe("Pareto Unificado", df_uni, desgloses_uni)
+                pdf_bytes = _pdf_memo("Pareto Unificado", df_uni, desgloses_uni, agregados_uni)
                 if pdf_bytes:
                     st.download_button(
                         label="📥 Descargar Informe PDF (Unificado)",
@@ -1321,6 +3232,14 @@ with tab_unificado:
                         mime="application/pdf"
                     )
 
+
+with tab_editor:
+    _seccion_editor()
+with tab_portafolio:
+    _seccion_portafolio()
+with tab_unificado:
+    _seccion_unificado()
+
 # ============================================================================
 # ============================== PARTE 10/10 ================================
 # ======================== Créditos y limpieza final ========================
@@ -1335,6 +3254,17 @@ Versión 2025⚙️
 </div>
 """, unsafe_allow_html=True)
 
+_tiempos = st.session_state.get("tiempos_render", {})
+_graf = _cache_graficos().stats()
+_rend = estadisticas_render()
+st.caption(
+    f"⏱️ Rerun completo: {(time.perf_counter() - _T0_RERUN) * 1000:.0f} ms · "
+    + " · ".join(f"{k}: {v:.0f} ms" for k, v in _tiempos.items())
+    + f" · 🖼️ caché de gráficos: {_graf['tasa_acierto']:.0%} aciertos, "
+      f"{_graf['entradas']} PNG ({_graf['bytes'] / 1e6:.1f} MB)"
+    + f" · figuras vivas: {_rend['figuras_vivas']} · RSS pico: {_rend['rss_pico_mb']:.0f} MB"
+)
+
 # Limpieza opcional de variables de sesión obsoletas
 for key in ["sheet_url_loaded", "reset_after_save"]:
     if key not in st.session_state:
@@ -0,0 +1,25 @@
+"""
+Carga las definiciones de app.py (partes 1-8) sin interfaz ni arranque de sesión,
+igual que tests/conftest.py, para medir funciones sueltas.
+"""
+import logging
+import types
+from pathlib import Path
+
+APP = Path(__file__).resolve().parents[1] / "app.py"
+
+
+def cargar() -> types.ModuleType:
+    fuente = APP.read_text(encoding="utf-8")
+    ini = fuente.index("# ---- Estado de sesión ----")
+    fin = fuente.index("# ---- Estilos PDF / páginas ----")
+    codigo = fuente[:ini] + "\n" * fuente.count("\n", ini, fin) + \
+        fuente[fin:fuente.index("# ============================== PARTE 9/10")]
+    mod = types.ModuleType("app_bench")
+    mod.__file__ = str(APP)
+    exec(compile(codigo, str(APP), "exec"), mod.__dict__)
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    for nombre in list(logging.root.manager.loggerDict):
+        if nombre.startswith("streamlit"):
+            logging.getLogger(nombre).setLevel(logging.ERROR)
+    return mod
@@ -0,0 +1,63 @@
+"""
+Arranque en frío: primer render de la app en un proceso nuevo.
+
+    python bench/arranque.py [ruta/a/app.py] [repeticiones]
+
+Cada medición corre en un subproceso limpio (sin módulos ni cachés de Streamlit
+cargados) y reporta la mediana. Para comparar con otra versión:
+
+    git show <rev>:app.py > /tmp/app_antes.py && python bench/arranque.py /tmp/app_antes.py
+"""
+import json
+import re
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+PESADOS = ("reportlab.platypus", "gspread", "google.oauth2.service_account",
+           "matplotlib.pyplot", "matplotlib.figure", "PIL.Image", "openpyxl")
+
+
+def medir(ruta: str):
+    """Se ejecuta en el subproceso: importa Streamlit, dibuja la app dos veces y sale."""
+    t = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+    t_streamlit = time.perf_counter() - t
+
+    url = re.search(r'^SPREADSHEET_URL\s*=\s*"([^"]+)"', Path(ruta).read_text(encoding="utf-8"), re.M).group(1)
+    at = AppTest.from_file(ruta, default_timeout=300)
+    at.session_state["portafolio"] = {}
+    at.session_state["portafolio_error"] = "sin red"  # no intentar cargar Sheets
+    at.session_state["sheet_url_loaded"] = url
+    t = time.perf_counter()
+    at.run()
+    t_primero = time.perf_counter() - t
+    assert not at.exception, [e.value for e in at.exception]
+    t = time.perf_counter()
+    at.run()
+    t_segundo = time.perf_counter() - t
+    print(json.dumps({"streamlit": t_streamlit, "primero": t_primero, "segundo": t_segundo,
+                      "cargados": [m for m in PESADOS if m in sys.modules]}))
+
+
+def main(ruta: str, repeticiones: int):
+    corridas = []
+    for _ in range(repeticiones):
+        salida = subprocess.run([sys.executable, __file__, "--medir", ruta],
+                                capture_output=True, text=True, check=True).stdout
+        corridas.append(json.loads(salida.strip().splitlines()[-1]))
+    for clave, etiqueta in (("streamlit", "import de Streamlit"), ("primero", "primer render"),
+                            ("segundo", "segundo render")):
+        print(f"{etiqueta:<20} {statistics.median(c[clave] for c in corridas) * 1000:7.0f} ms (mediana de {repeticiones})")
+    print("módulos pesados cargados tras el primer render:", corridas[-1]["cargados"] or "ninguno")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--medir"]:
+        medir(sys.argv[2])
+    else:
+        args = sys.argv[1:]
+        main(args[0] if args else str(Path(__file__).resolve().parents[1] / "app.py"),
+             int(args[1]) if len(args) > 1 else 5)
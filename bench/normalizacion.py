@@ -0,0 +1,58 @@
+"""
+Pasadas de normalización de mapas de frecuencias por rerun.
+
+    python bench/normalizacion.py [ruta/a/app.py]
+
+Cuenta las llamadas a pd.to_numeric (una por entrada en la normalización escalar)
+durante reruns de la app con 30 Paretos en sesión. Para comparar con otra versión:
+
+    git show <rev>:app.py > /tmp/app_antes.py && python bench/normalizacion.py /tmp/app_antes.py
+"""
+import random
+import re
+import sys
+from pathlib import Path
+
+import pandas as pd
+from streamlit.testing.v1 import AppTest
+
+DESCRIPTORES = ["Hurto", "Homicidio", "Robo a personas", "Estafa o defraudación", "Lesiones",
+                "Amenazas", "Venta de drogas", "Femicidio", "Aborto", "Bares clandestinos"]
+
+
+def main(ruta: str):
+    url = re.search(r'^SPREADSHEET_URL\s*=\s*"([^"]+)"', Path(ruta).read_text(encoding="utf-8"), re.M).group(1)
+    original = pd.to_numeric
+    cuenta = {"n": 0}
+
+    def contado(*a, **k):
+        cuenta["n"] += 1
+        return original(*a, **k)
+
+    pd.to_numeric = contado
+    random.seed(3)
+    at = AppTest.from_file(ruta, default_timeout=300)
+    at.session_state["portafolio"] = {f"Pareto {i}": {d: random.randint(1, 30) for d in random.sample(DESCRIPTORES, 8)}
+                                      for i in range(30)}
+    at.session_state["portafolio_error"] = "sin red"  # no intentar cargar Sheets
+    at.session_state["sheet_url_loaded"] = url
+    at.session_state["msel"] = DESCRIPTORES[:8]
+    at.session_state["freq_map"] = {d: i + 1 for i, d in enumerate(DESCRIPTORES[:8])}
+    at.run()
+    assert not at.exception, [e.value for e in at.exception]
+
+    for etiqueta in ("primer rerun", "rerun"):
+        cuenta["n"] = 0
+        at.run()
+        print(f"{etiqueta:<28} pd.to_numeric: {cuenta['n']}")
+    abrir = [t for t in at.toggle if t.key == "open_Pareto 1"]
+    if abrir:
+        abrir[0].set_value(True)
+        cuenta["n"] = 0
+        at.run()
+        assert not at.exception, [e.value for e in at.exception]
+        print(f"{'rerun con un Pareto abierto':<28} pd.to_numeric: {cuenta['n']}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else str(Path(__file__).resolve().parents[1] / "app.py"))
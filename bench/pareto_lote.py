@@ -0,0 +1,62 @@
+"""
+calcular_paretos_lote frente a calcular_pareto en un bucle (1k y 10k Paretos).
+
+    python bench/pareto_lote.py [n_paretos ...]
+
+Verifica primero que el lote dé el mismo resultado que calcular_pareto por nombre.
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from _app import cargar
+
+
+def portafolio(app, n: int, rs: np.random.RandomState):
+    descs = [r["descriptor"] for r in app.CATALOGO]
+    return {
+        f"Pareto {i}": {d: int(f) for d, f in zip(rs.choice(descs, rs.randint(1, 40), replace=False),
+                                                   rs.randint(0, 30, 40))}
+        for i in range(n)
+    }
+
+
+def main(tamanos):
+    app = cargar()
+    rs = np.random.RandomState(1)
+
+    # Misma entrada (y mismo orden de empates) para ambos caminos
+    largo = app.PortafolioMatricial(portafolio(app, 300, rs)).largo()
+    lote = app.separar_paretos(app.calcular_paretos_lote(largo))
+    for nombre, filas in largo.groupby("nombre", sort=False):
+        solo = app.calcular_pareto(filas[["descriptor", "frecuencia"]])
+        if nombre not in lote:
+            assert solo.empty, nombre
+            continue
+        pd.testing.assert_frame_equal(solo, lote[nombre][solo.columns], check_dtype=False)
+    print("equivalencia con calcular_pareto: 300 Paretos OK")
+
+    for n in tamanos:
+        port = portafolio(app, n, rs)
+        t = time.perf_counter()
+        for m in port.values():
+            app.calcular_pareto(app.df_desde_freq_map(m))
+        t_bucle = time.perf_counter() - t
+
+        t = time.perf_counter()
+        largo = app.PortafolioMatricial(port).largo()
+        t_tabla = time.perf_counter() - t
+        t = time.perf_counter()
+        res = app.calcular_paretos_lote(largo)
+        t_lote = time.perf_counter() - t
+        t = time.perf_counter()
+        app.separar_paretos(res)
+        t_separar = time.perf_counter() - t
+        print(f"{n:>6} Paretos ({len(largo)} filas): bucle {t_bucle:.2f} s | "
+              f"lote {t_lote:.3f} s (+tabla larga {t_tabla:.3f} s, +separar {t_separar:.2f} s)")
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [1000, 10000])
@@ -0,0 +1,40 @@
+"""
+Carga las definiciones de app.py sin ejecutar la interfaz.
+
+app.py es un script de Streamlit: al importarlo dibuja la app. Las pruebas
+ejecutan solo las definiciones de las partes 1-8 (configuración, cálculo, gráficos,
+conectores y PDF) en un espacio de nombres propio, en modo "bare" (sin servidor).
+El arranque de sesión de la parte 6 (lectura del portafolio desde Sheets, secretos,
+hilos de escritura y sincronización) no se ejecuta.
+"""
+import logging
+from pathlib import Path
+
+import pytest
+
+APP = Path(__file__).resolve().parents[1] / "app.py"
+CORTE_UI = "# ============================== PARTE 9/10"
+INICIO_SESION = "# ---- Estado de sesión ----"
+FIN_SESION = "# ---- Estilos PDF / páginas ----"
+
+
+@pytest.fixture(scope="session")
+def app():
+    import threading
+    import types
+
+    fuente = APP.read_text(encoding="utf-8")
+    ini, fin = fuente.index(INICIO_SESION), fuente.index(FIN_SESION)
+    # El bloque de sesión se sustituye por líneas vacías para conservar la numeración
+    codigo = fuente[:ini] + "\n" * fuente.count("\n", ini, fin) + fuente[fin:fuente.index(CORTE_UI)]
+    mod = types.ModuleType("app_sin_ui")
+    mod.__file__ = str(APP)
+    exec(compile(codigo, str(APP), "exec"), mod.__dict__)
+    hilos = {h.name for h in threading.enumerate()} & {"sheets-write-behind", "sheets-pull-sync"}
+    assert not hilos, f"la carga de app.py arrancó hilos de Sheets: {hilos}"
+    # Sin servidor, cada llamada a st.cache_* registra "missing ScriptRunContext";
+    # pytest guarda esos registros y falsearía las mediciones de memoria.
+    for nombre in list(logging.root.manager.loggerDict):
+        if nombre.startswith("streamlit"):
+            logging.getLogger(nombre).setLevel(logging.ERROR)
+    return mod
@@ -0,0 +1,91 @@
+"""Capa de render de gráficos: figuras liberadas, memoria acotada y render concurrente."""
+import gc
+import weakref
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+TIPOS_MODALIDADES = ["barh", "bar", "donut", "lollipop", "comp100", "pill"]
+PARES = [("Vía pública", 45.0), ("Vivienda", 30.0), ("Comercio", 25.0)]
+
+CALENTAMIENTO = 60     # cachés de fuentes/texto de Matplotlib y del asignador
+ITERACIONES = 240
+RSS_EXTRA_MAX_MB = 10  # una figura retenida a estos tamaños son cientos de KB
+OBJETOS_EXTRA_MAX = 500
+HILOS = 8
+
+
+def _df_pareto(app):
+    return app.calcular_pareto(pd.DataFrame({
+        "descriptor": [f"Descriptor {i} con texto largo" for i in range(8)],
+        "frecuencia": [40, 25, 12, 9, 6, 4, 3, 1],
+    }))
+
+
+def _objetos_vivos() -> int:
+    """Objetos rastreados por el GC, sin las weakrefs que Matplotlib purga por lotes."""
+    gc.collect()
+    return sum(1 for o in gc.get_objects() if not isinstance(o, weakref.ref))
+
+
+def _rss_mb() -> float:
+    """RSS actual (no el pico) del proceso; solo Linux."""
+    return int(Path("/proc/self/statm").read_text().split()[1]) * 4096 / 2 ** 20
+
+
+def test_memoria_plana_en_renders_reales(app, monkeypatch):
+    if not Path("/proc/self/statm").exists():
+        pytest.skip("RSS actual solo disponible vía /proc")
+    # Mismas rutas de render, a baja resolución para que la prueba sea rápida
+    for dpi in ("PREVIEW_DPI", "PARETO_PDF_DPI", "MODALIDADES_DPI"):
+        monkeypatch.setattr(app, dpi, 40)
+    df_par = _df_pareto(app)
+    renders = [
+        lambda i: app._pareto_preview_png(df_par, "Vista previa"),
+        lambda i: app._pareto_png_render(df_par, "Pareto"),  # lo que _pareto_png genera si no está en caché
+        lambda i: app._modalidades_png_render("Modalidades", PARES, kind=TIPOS_MODALIDADES[i % 6]),
+    ]
+
+    def iterar(n: int):
+        for i in range(n):
+            png = renders[i % len(renders)](i)
+            assert png.startswith(b"\x89PNG")
+            assert app.estadisticas_render()["figuras_vivas"] == 0
+
+    errores_antes = app.estadisticas_render()["errores"]
+    iterar(CALENTAMIENTO)
+    objetos_base, rss_base = _objetos_vivos(), _rss_mb()
+
+    iterar(ITERACIONES)
+    nuevos = _objetos_vivos() - objetos_base
+    crecimiento = _rss_mb() - rss_base
+    assert nuevos < OBJETOS_EXTRA_MAX, f"{nuevos} objetos retenidos tras {ITERACIONES} renders"
+    assert crecimiento < RSS_EXTRA_MAX_MB, f"RSS creció {crecimiento:.1f} MB en {ITERACIONES} renders"
+    assert app.estadisticas_render()["errores"] == errores_antes
+
+
+
+def test_render_concurrente_igual_al_serial(app):
+    from concurrent.futures import ThreadPoolExecutor
+
+    df_par = _df_pareto(app)
+    trabajos = [("pareto", f"Pareto {i}") for i in range(2)] + \
+               [("modalidades", tipo) for tipo in TIPOS_MODALIDADES]
+
+    def render(trabajo) -> bytes:
+        clase, arg = trabajo
+        if clase == "pareto":
+            return app._pareto_png_render(df_par, arg)
+        return app._modalidades_png_render("Modalidades", PARES, kind=arg)
+
+    serial = {t: render(t) for t in trabajos}
+    lote = trabajos * 3
+    with ThreadPoolExecutor(max_workers=HILOS) as pool:
+        concurrente = list(pool.map(render, lote))
+
+    distintos = [t for t, png in zip(lote, concurrente) if png != serial[t]]
+    assert not distintos, f"{len(distintos)} renders concurrentes difieren del serial: {distintos}"
+    est = app.estadisticas_render()
+    assert est["figuras_vivas"] == 0
+    assert est["errores"] == 0